@@ -0,0 +1,65 @@
+#!/usr/bin/python
+"""Measure memory retained per notification message and the cost of reading
+the fields the Nuimo handler uses (attHandle and data[0:2]), comparing the
+lazily decoded message objects with the former eagerly decoded ones.
+
+tracemalloc is not available on the Python 2 this project runs on, so
+retained memory is summed with sys.getsizeof over each message's containers.
+
+    python benchmarks/bench_alloc.py [messages]
+"""
+
+import sys
+import time
+
+import fakes
+from bled112 import Uint16, makeBleMessage
+
+
+class LegacyAttClientAttributeValueEvent(object):
+    """The former eagerly decoded, dict-backed notification message."""
+    def __init__(self, frame):
+        self.header = list(frame[0:4])
+        self.payload = payload = list(frame[4:])
+        self.connection = payload[0]
+        self.attHandle = Uint16().deserialize(payload[1:3])
+        self.type = payload[3]
+        self.data = payload[5:]
+
+
+def retained(message):
+    size = sys.getsizeof(message)
+    values = []
+    if hasattr(message, '__dict__'):
+        size += sys.getsizeof(message.__dict__)
+        values.extend(message.__dict__.values())
+    for cls in type(message).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            values.append(getattr(message, name))
+    for value in values:
+        if isinstance(value, (list, bytearray, str)):
+            size += sys.getsizeof(value)
+    return size
+
+
+def measure(factory, frames):
+    start = time.clock()
+    messages = []
+    for frame in frames:
+        message = factory(frame)
+        message.attHandle, message.data[0:2]
+        messages.append(message)
+    cpu = (time.clock() - start) / len(frames) * 1e6
+    return retained(messages[0]), cpu
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    frames = [bytearray(fakes.notification(0, 0x1d, [i & 0xFF, 0])) for i in range(count)]
+    print '%-10s %16s %14s' % ('message', 'bytes/message', 'cpu us/frame')
+    for name, factory in (('eager', LegacyAttClientAttributeValueEvent), ('lazy', makeBleMessage)):
+        print '%-10s %16d %14.2f' % ((name,) + measure(factory, frames))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""Press the button against a stand-in speaker and measure gesture-to-LED
+and gesture-to-speaker latency separately, for the former synchronous
+handler and the optimistic one. A speaker that rejects play shows how the
+LED is corrected.
+
+    python benchmarks/bench_button.py [speaker latency s] [presses]
+"""
+
+import sys
+import threading
+import time
+
+from fakes import FakeSonos
+import led_configs
+from controller import NuimoSonosController
+from sonos import SonosAPI
+
+
+class FakeNuimo(object):
+    def __init__(self):
+        self.shown = []
+        self.changed = threading.Event()
+
+    def display_led_matrix(self, matrix, timeout):
+        self.shown.append(matrix)
+        self.changed.set()
+
+
+class SynchronousController(NuimoSonosController):
+    """The former handler: send the command, then draw."""
+    def on_button(self):
+        started = time.time()
+        if self.sonos.is_playing():
+            self.sonos.pause()
+            self.nuimo.display_led_matrix(led_configs.pause, self.default_led_timeout)
+        else:
+            self.sonos.play()
+            self.nuimo.display_led_matrix(led_configs.play, self.default_led_timeout)
+        self.led_latency = self.speaker_latency = time.time() - started
+
+
+def press(controller):
+    controller.speaker_latency = None
+    controller.on_button()
+    while controller.speaker_latency is None:
+        time.sleep(0.001)
+    return controller.led_latency, controller.speaker_latency
+
+
+def measure(controllerClass, latency, presses):
+    sonos = SonosAPI(FakeSonos(1, latency=latency).players)
+    controller = controllerClass(None, None, nuimo=FakeNuimo(), sonos=sonos)
+    samples = [press(controller) for _ in range(presses)]
+    sonos.disconnect()
+    led = sorted(sample[0] for sample in samples)
+    speaker = sorted(sample[1] for sample in samples)
+    return led[len(led) // 2] * 1000, speaker[len(speaker) // 2] * 1000
+
+
+def correction(latency):
+    sonos = SonosAPI(FakeSonos(1, latency=latency, failure_rate=1.0).players)
+    nuimo = FakeNuimo()
+    controller = NuimoSonosController(None, None, nuimo=nuimo, sonos=sonos)
+    started = time.time()
+    controller.on_button()
+    while led_configs.error not in nuimo.shown:
+        time.sleep(0.001)
+    corrected = time.time() - started
+    sonos.disconnect()
+    return nuimo.shown[0] is led_configs.play, corrected * 1000, sonos.state
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.08
+    presses = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print '%-12s %18s %22s' % ('handler', 'gesture->LED ms', 'gesture->speaker ms')
+    for name, controllerClass in (('synchronous', SynchronousController), ('optimistic', NuimoSonosController)):
+        print '%-12s %18.2f %22.2f' % ((name,) + measure(controllerClass, latency, presses))
+    predicted, corrected, state = correction(latency)
+    print 'failed play: predicted icon %s, error shown after %.1f ms, state back to %s' % (
+        'drawn' if predicted else 'missing', corrected, state)
+
+
+if __name__ == '__main__':
+    main()
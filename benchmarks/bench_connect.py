@@ -0,0 +1,62 @@
+#!/usr/bin/python
+"""Measure connect plus characteristic discovery time against a virtual
+Nuimo, with event-driven response waiting versus the former 10 ms polling.
+
+    python benchmarks/bench_connect.py [rounds]
+"""
+
+import sys
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager, Timeout
+from nuimo import SERVICE_UUIDS
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+
+
+class PollingBleManager(BleManager):
+    """Waits the way BleManager used to: sleep 10 ms until resolved."""
+    def waitForMessage(self, waiter, timeout):
+        t = Timeout(timeout)
+        while not waiter.is_done():
+            if t.isExpired():
+                self.expireWaiter(waiter)
+                break
+            time.sleep(0.01)
+        return waiter.value
+
+    def request(self, *args):
+        request = BleManager.request(self, *args)
+        while not request.is_done():
+            time.sleep(0.01)
+        return request
+
+
+def connectAndDiscover(managerClass):
+    com = Bled112Com(serialDevice=LoopbackSerial(VirtualDongle(ADDRESS)))
+    com.start()
+    try:
+        ble = managerClass(com, ADDRESS)
+        start = time.time()
+        ble.connect()
+        for group in ble.readAll().values():
+            if group.uuid in SERVICE_UUIDS:
+                ble.findInformation(group.start, group.end)
+        return time.time() - start
+    finally:
+        com.close()
+        com.join()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print '%-10s %14s' % ('waiting', 'ms/connect')
+    for name, managerClass in (('polling', PollingBleManager), ('event', BleManager)):
+        elapsed = [connectAndDiscover(managerClass) for _ in range(rounds)]
+        print '%-10s %14.1f' % (name, sum(elapsed) / rounds * 1000)
+
+
+if __name__ == '__main__':
+    main()
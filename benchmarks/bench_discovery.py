@@ -0,0 +1,58 @@
+#!/usr/bin/python
+"""Compare characteristic discovery against a virtual Nuimo: a group read
+plus one FindInformation per service versus a single FindInformation over
+the whole attribute table that ends once every wanted UUID was seen.
+
+    python benchmarks/bench_discovery.py [rounds]
+"""
+
+import sys
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager
+from nuimo import CHARACTERISTIC_UUIDS, SERVICE_UUIDS
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+
+
+def perService(ble):
+    handles = {}
+    for group in ble.readAll().values():
+        if group.uuid in SERVICE_UUIDS:
+            handles.update(ble.findInformation(group.start, group.end))
+    return handles
+
+
+def singlePass(ble):
+    return ble.findInformation(1, 0xFFFF, CHARACTERISTIC_UUIDS.keys())
+
+
+def discover(strategy):
+    com = Bled112Com(serialDevice=LoopbackSerial(VirtualDongle(ADDRESS)))
+    com.start()
+    try:
+        ble = BleManager(com, ADDRESS)
+        ble.connect()
+        issued = ble.scheduler.issued
+        start = time.time()
+        handles = strategy(ble)
+        elapsed = time.time() - start
+        assert set(CHARACTERISTIC_UUIDS).issubset(handles)
+        return ble.scheduler.issued - issued, elapsed
+    finally:
+        com.close()
+        com.join()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print '%-12s %12s %14s' % ('discovery', 'round trips', 'ms/discovery')
+    for name, strategy in (('per-service', perService), ('single-pass', singlePass)):
+        results = [discover(strategy) for _ in range(rounds)]
+        print '%-12s %12d %14.1f' % (name, results[0][0], sum(r[1] for r in results) / rounds * 1000)
+
+
+if __name__ == '__main__':
+    main()
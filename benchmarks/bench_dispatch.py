@@ -0,0 +1,52 @@
+#!/usr/bin/python
+"""Measure parse-and-dispatch cost per incoming frame of makeBleMessage with
+the import-time dispatch index versus a lookup table rebuilt per frame.
+
+    python benchmarks/bench_dispatch.py [frames]
+"""
+
+import sys
+import time
+
+import fakes
+from bled112 import *
+
+
+def legacyMakeBleMessage(frame):
+    lookup = {
+        tuple(AttClientAttributePrepareWriteResponse().header) : AttClientAttributePrepareWriteResponse,
+        tuple(AttClientAttributeValueEvent().header) : AttClientAttributeValueEvent,
+        tuple(AttClientAttributeWriteResponse().header) : AttClientAttributeWriteResponse,
+        tuple(AttClientExecuteWriteCommandResponse().header) : AttClientExecuteWriteCommandResponse,
+        tuple(AttClientFindInformationFoundEvent().header) : AttClientFindInformationFoundEvent,
+        tuple(AttClientFindInformationResponse().header) : AttClientFindInformationResponse,
+        tuple(AttClientGroupFoundEvent().header) : AttClientGroupFoundEvent,
+        tuple(AttClientProcedureCompleted().header) : AttClientProcedureCompleted,
+        tuple(AttClientReadByHandleResponse().header) : AttClientReadByHandleResponse,
+        tuple(ConnectDirectResponse().header) : ConnectDirectResponse,
+        tuple(ConnectionDisconnectedEvent().header) : ConnectionDisconnectedEvent,
+        tuple(ConnectionStatusEvent().header) : ConnectionStatusEvent,
+        tuple(FindByTypeValueResponse().header) : FindByTypeValueResponse,
+        tuple(ReadByGroupTypeResponse().header) : ReadByGroupTypeResponse,
+    }
+    ctor = lookup.get(tuple([frame[0], 0, frame[2], frame[3]]))
+    return ctor(frame)
+
+
+def measure(factory, frames):
+    start = time.clock()
+    for frame in frames:
+        factory(frame)
+    return (time.clock() - start) / len(frames) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    frames = [bytearray(fakes.notification(0, 0x1d, [3, 0]))] * count
+    print '%-10s %14s' % ('dispatch', 'cpu us/frame')
+    for name, factory in (('legacy', legacyMakeBleMessage), ('indexed', makeBleMessage)):
+        print '%-10s %14.2f' % (name, measure(factory, frames))
+
+
+if __name__ == '__main__':
+    main()
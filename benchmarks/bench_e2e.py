@@ -0,0 +1,304 @@
+#!/usr/bin/python
+"""Drive gestures through the whole pipeline. The BLED112 emulator writes
+notifications to a pty, and Bled112Com reads them. From there they pass
+through BleManager, Nuimo and its MessageHandler, then
+NuimoSonosController and SonosAPI, to a FakeSonos speaker. For each
+gesture type the script reports the latency from serial RX to the speaker
+change and to the LED write (p50/p99). A burst of the same gesture then
+gives the throughput and the number of dropped events. Results can be
+written as JSON and two such files compared, e.g. before and after a
+change.
+
+    python benchmarks/bench_e2e.py [-o results.json] [--latency s] [samples] [burst]
+    python benchmarks/bench_e2e.py --compare before.json after.json
+"""
+
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from emulator import Bled112Emulator
+from fakes import FakeSonos, MemoryHandleCache, VirtualDongle
+from controller import NuimoSonosController
+from nuimo import Nuimo
+from sonos import SonosAPI
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+LED_UUID = 'f29b1524-cb19-40f3-be5c-7241ecb82fd1'
+# Neighbours differ in LED frame so that none is dropped as a duplicate
+GESTURES = ['button', 'swipe_right', 'rotate_right', 'swipe_left', 'rotate_left', 'fly_right', 'fly_left']
+METRICS = ['speaker_p50_ms', 'speaker_p99_ms', 'led_p50_ms', 'led_p99_ms', 'dropped', 'throughput']
+
+
+class Probe(object):
+    """Timestamps of one gesture: its notification reaching the serial
+    port, the speaker carrying out the command and the LED frame arriving
+    at the dongle. Also counts speaker changes, e.g. during a burst.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.armed = False
+        self.rx = self.speaker = self.led = None
+        self.changes = 0
+        self.last_change = None
+
+    def arm(self):
+        with self.condition:
+            self.armed = True
+            self.rx = self.speaker = self.led = self.last_change = None
+            self.changes = 0
+
+    def on_rx(self):
+        with self.condition:
+            if self.armed and self.rx is None:
+                self.rx = time.time()
+
+    def on_speaker(self, player, what):
+        with self.condition:
+            self.last_change = time.time()
+            self.changes += 1
+            if self.rx is not None and self.speaker is None:
+                self.speaker = self.last_change
+                self.condition.notify_all()
+
+    def on_led(self):
+        with self.condition:
+            if self.rx is not None and self.led is None:
+                self.led = time.time()
+                self.condition.notify_all()
+
+    def wait(self, timeout, grace):
+        """Latencies of the speaker change and the LED write, or None for
+        one that did not happen. The LED may follow the speaker by grace.
+        """
+        with self.condition:
+            deadline = time.time() + timeout
+            while self.speaker is None and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            deadline = time.time() + grace
+            while self.led is None and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            self.armed = False
+            return [None if at is None or self.rx is None else at - self.rx for at in (self.speaker, self.led)]
+
+
+class TimedDongle(VirtualDongle):
+    def __init__(self, probe):
+        VirtualDongle.__init__(self, ADDRESS)
+        self.probe = probe
+        self.ledHandle = self.valueHandle(LED_UUID)
+
+    def attributeWrite(self, payload):
+        self.written(payload)
+        return VirtualDongle.attributeWrite(self, payload)
+
+    def writeCommand(self, payload):
+        self.written(payload)
+        return VirtualDongle.writeCommand(self, payload)
+
+    def written(self, payload):
+        if payload[1] + payload[2] * 256 == self.ledHandle:
+            self.probe.on_led()
+
+
+class TimedEmulator(Bled112Emulator):
+    """Stamps each notification as it is written to the pty."""
+    def __init__(self, probe):
+        Bled112Emulator.__init__(self, TimedDongle(probe))
+        self.probe = probe
+
+    def emit(self, data):
+        if data[0] == '\x80' and data[2:4] == '\x04\x05':
+            self.probe.on_rx()
+        Bled112Emulator.emit(self, data)
+
+
+class CountingController(NuimoSonosController):
+    """Counts the gestures reaching the controller."""
+    def __init__(self, port, sonos):
+        self.handled = collections.Counter()
+        NuimoSonosController.__init__(self, None, None, nuimo=Nuimo(port, ADDRESS, self, MemoryHandleCache()),
+                                      sonos=sonos)
+
+    def on_button(self):
+        self.handled['button'] += 1
+        NuimoSonosController.on_button(self)
+
+    def on_swipe_right(self):
+        self.handled['swipe_right'] += 1
+        NuimoSonosController.on_swipe_right(self)
+
+    def on_swipe_left(self):
+        self.handled['swipe_left'] += 1
+        NuimoSonosController.on_swipe_left(self)
+
+    def on_fly_right(self):
+        self.handled['fly_right'] += 1
+        NuimoSonosController.on_swipe_right(self)
+
+    def on_fly_left(self):
+        self.handled['fly_left'] += 1
+        NuimoSonosController.on_swipe_left(self)
+
+    def on_wheel_right(self, value):
+        self.handled['rotate_right'] += 1
+        NuimoSonosController.on_wheel_right(self, value)
+
+    def on_wheel_left(self, value):
+        self.handled['rotate_left'] += 1
+        NuimoSonosController.on_wheel_left(self, value)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+
+def latencies(emulator, probe, samples):
+    """Single gestures, one at a time, in GESTURES order."""
+    speaker = collections.defaultdict(list)
+    led = collections.defaultdict(list)
+    missed = collections.Counter()
+    for _ in range(samples):
+        for name in GESTURES:
+            probe.arm()
+            emulator.gesture(name, 10)
+            toSpeaker, toLed = probe.wait(1.0, 0.1)
+            if toSpeaker is None:
+                missed[name] += 1
+            else:
+                speaker[name].append(toSpeaker)
+            if toLed is not None:
+                led[name].append(toLed)
+            time.sleep(0.02)
+    return speaker, led, missed
+
+
+def burst(emulator, controller, probe, name, count, settle):
+    """Sends count gestures back to back and waits for the speaker to go
+    quiet. Returns sent, handled, merged, dropped, speaker changes and
+    gestures carried per second.
+    """
+    handler = controller.nuimo.message_handler
+    handled, merged = controller.handled[name], handler.merged
+    probe.arm()
+    started = time.time()
+    sent = sum(1 for _ in range(count) if emulator.gesture(name, 10))
+    while time.time() - (probe.last_change or started) < settle:
+        time.sleep(0.05)
+    probe.armed = False
+    handled = controller.handled[name] - handled
+    merged = handler.merged - merged
+    dropped = sent - handled - merged
+    elapsed = probe.last_change - probe.rx if probe.last_change and probe.rx else None
+    return sent, handled, merged, dropped, probe.changes, (sent - dropped) / elapsed if elapsed else None
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(samples, count, latency):
+    probe = Probe()
+    fake = FakeSonos(1, latency=latency)
+    for player in fake.players:
+        player.on_change = probe.on_speaker
+    emulator = TimedEmulator(probe)
+    controller = CountingController(emulator.port, SonosAPI(fake.players))
+    try:
+        controller.nuimo.connect()
+        speaker, led, missed = latencies(emulator, probe, samples)
+        gestures = {}
+        for name in GESTURES:
+            sent, handled, merged, dropped, changes, throughput = burst(
+                emulator, controller, probe, name, count, max(0.5, latency * 10))
+            gestures[name] = {
+                'samples': len(speaker[name]),
+                'missed': missed[name],
+                'speaker_p50_ms': percentile(speaker[name], 0.5),
+                'speaker_p99_ms': percentile(speaker[name], 0.99),
+                'led_p50_ms': percentile(led[name], 0.5),
+                'led_p99_ms': percentile(led[name], 0.99),
+                'sent': sent,
+                'handled': handled,
+                'merged': merged,
+                'dropped': dropped,
+                'speaker_changes': changes,
+                'throughput': throughput,
+            }
+    finally:
+        controller.shutdown()
+        emulator.close()
+    return {
+        'revision': revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {'samples': samples, 'burst': count, 'speaker_latency': latency},
+        'gestures': gestures,
+    }
+
+
+def show(value, format='%10.2f'):
+    return format % value if value is not None else '%10s' % '-'
+
+
+def report(results):
+    print 'revision %s, speaker latency %.0f ms' % (results['revision'],
+                                                    results['parameters']['speaker_latency'] * 1000)
+    print '%-13s %10s %10s %10s %10s %6s %8s %8s %10s' % (
+        'gesture', 'spk p50', 'spk p99', 'led p50', 'led p99', 'sent', 'merged', 'dropped', 'gestures/s')
+    for name in GESTURES:
+        g = results['gestures'][name]
+        print '%-13s %s %s %s %s %6d %8d %8d %s' % (
+            name, show(g['speaker_p50_ms']), show(g['speaker_p99_ms']), show(g['led_p50_ms']),
+            show(g['led_p99_ms']), g['sent'], g['merged'], g['dropped'], show(g['throughput'], '%10.1f'))
+
+
+def compare(before, after):
+    print '%s -> %s' % (before['revision'], after['revision'])
+    print '%-13s %-15s %10s %10s %9s' % ('gesture', 'metric', 'before', 'after', 'change')
+    for name in GESTURES:
+        for metric in METRICS:
+            old, new = before['gestures'][name][metric], after['gestures'][name][metric]
+            change = '%+8.1f%%' % ((new - old) * 100.0 / old) if old and new is not None else '%9s' % '-'
+            print '%-13s %-15s %s %s %s' % (name, metric, show(old), show(new), change)
+
+
+def main():
+    arguments = sys.argv[1:]
+    if arguments[:1] == ['--compare']:
+        with open(arguments[1]) as before, open(arguments[2]) as after:
+            compare(json.load(before), json.load(after))
+        return
+
+    output, latency, positional = None, 0.02, []
+    while arguments:
+        argument = arguments.pop(0)
+        if argument == '-o':
+            output = arguments.pop(0)
+        elif argument == '--latency':
+            latency = float(arguments.pop(0))
+        else:
+            positional.append(int(argument))
+    samples = positional[0] if positional else 20
+    count = positional[1] if len(positional) > 1 else 50
+
+    results = run(samples, count, latency)
+    report(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'results written to %s' % output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""Push RenderingControl events from stand-in players through SonosAPI and
+measure events per second and shutdown time: the former polling receiver
+thread per subscription versus the single EventDispatcher.
+
+    python benchmarks/bench_events.py [events] [players]
+"""
+
+import sys
+import threading
+import time
+from Queue import Empty
+
+from fakes import FakeEvent, FakeService, FakeSonos
+from sonos import SonosAPI
+
+
+class PollingReceiver(threading.Thread):
+    """The former receiver: one thread per subscription, polling twice a second."""
+    def __init__(self, service, callback):
+        super(PollingReceiver, self).__init__()
+        self.subscription = service.subscribe()
+        self.callback = callback
+        self.terminate = False
+
+    def run(self):
+        while True:
+            if self.terminate:
+                self.subscription.unsubscribe()
+                break
+            try:
+                self.callback(self.subscription.events.get(timeout=0.5))
+            except Empty:
+                pass
+
+    def stop(self):
+        self.terminate = True
+
+
+class Counter(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.count = 0
+
+    def __call__(self, event):
+        self.callback(event)
+        self.count += 1
+
+
+def polling(players, sonos):
+    services = [FakeService() for _ in players]
+    counters = [Counter(sonos._make_rendering_callback(player)) for player in players]
+    receivers = [PollingReceiver(service, counter) for service, counter in zip(services, counters)]
+    for receiver in receivers:
+        receiver.start()
+
+    def stop():
+        for receiver in receivers:
+            receiver.stop()
+        for receiver in receivers:
+            receiver.join()
+    return services, lambda: sum(counter.count for counter in counters), stop
+
+
+def dispatcher(players, sonos):
+    services = [player.renderingControl for player in players]
+    base = sonos.dispatcher.dispatched
+    return services, lambda: sonos.dispatcher.dispatched - base, sonos.disconnect
+
+
+def measure(setup, count, size):
+    players = FakeSonos(size).players
+    sonos = SonosAPI(players)
+    services, processed, stop = setup(players, sonos)
+    start = time.time()
+    for i in range(count):
+        services[i % size].emit(FakeEvent(volume={'Master': str(i % 100)}))
+    while processed() < count:
+        time.sleep(0.0005)
+    elapsed = time.time() - start
+    start = time.time()
+    stop()
+    stopped = time.time() - start
+    if setup is polling:
+        sonos.disconnect()
+    return count / elapsed, stopped * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print '%-12s %14s %14s' % ('receiver', 'events/s', 'shutdown ms')
+    for name, setup in (('polling', polling), ('dispatcher', dispatcher)):
+        print '%-12s %14.0f %14.1f' % ((name,) + measure(setup, count, size))
+
+
+if __name__ == '__main__':
+    main()
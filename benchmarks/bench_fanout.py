@@ -0,0 +1,53 @@
+#!/usr/bin/python
+"""Measure SonosAPI.set_volume latency against N stand-in players, the
+sequential loop versus the worker pool, with and without one slow speaker.
+
+    python benchmarks/bench_fanout.py [latency s] [calls]
+"""
+
+import sys
+import time
+
+from fakes import FakeSonos
+from sonos import SonosAPI
+
+
+class SequentialSonosAPI(SonosAPI):
+    """The former volume write: one player after another."""
+    def _set_volume(self, value):
+        for player in self.players:
+            player.volume = value
+            self._update_volume(player, value)
+
+
+def measure(api, count, latency, slow, calls):
+    players = FakeSonos(count, latency=latency).players
+    if slow:
+        players[-1].latency = 2.0
+    sonos = api(players)
+    samples = []
+    for i in range(calls):
+        start = time.time()
+        sonos.set_volume(20 + i % 10)
+        samples.append(time.time() - start)
+    sonos.disconnect()
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, samples[-1] * 1000
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.03
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print '%-8s %-11s %-6s %12s %12s' % ('players', 'write', 'slow', 'median ms', 'max ms')
+    for count in (1, 2, 4, 6):
+        for slow in (False, True):
+            if slow and count == 1:
+                continue
+            for name, api in (('sequential', SequentialSonosAPI), ('pool', SonosAPI)):
+                runs = 2 if slow and name == 'sequential' else calls
+                print '%-8d %-11s %-6s %12.1f %12.1f' % ((count, name, 'yes' if slow else 'no')
+                                                        + measure(api, count, latency, slow, runs))
+
+
+if __name__ == '__main__':
+    main()
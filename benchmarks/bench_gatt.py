@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""Measure throughput of back-to-back LED matrix and CCCD writes against a
+virtual Nuimo, waiting for each write in turn versus queueing them all on
+the GATT scheduler, and check that no response was lost or misattributed.
+
+    python benchmarks/bench_gatt.py [writes]
+"""
+
+import sys
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+LED_HANDLE = 0x1b
+CCCD_HANDLES = [0x0b, 0x0f, 0x12, 0x15, 0x18]
+
+
+def run(writes, pipelined):
+    dongle = VirtualDongle(ADDRESS)
+    device = LoopbackSerial(dongle)
+    com = Bled112Com(serialDevice=device)
+    com.start()
+    try:
+        ble = BleManager(com, ADDRESS)
+        ble.connect()
+        start = time.time()
+        requests = []
+        for handle, data in writes:
+            requests.append(ble.writeAttributeByHandle(handle, data, wait=not pipelined))
+        for request in requests:
+            request.result()
+        elapsed = time.time() - start
+        assert dongle.writes == writes, 'writes lost or reordered'
+        assert all(r.value.chrHandle == h for r, (h, _) in zip(requests, writes)), 'misattributed completion'
+        return len(writes) / elapsed
+    finally:
+        com.close()
+        com.join()
+        device.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    led = [(LED_HANDLE, [i & 0xFF] * 11 + [255, 30]) for i in range(count)]
+    cccd = [(handle, [1]) for handle in CCCD_HANDLES]
+    print '%-10s %14s %14s' % ('writes', 'led writes/s', 'cccd writes/s')
+    for name, pipelined in (('blocking', False), ('pipelined', True)):
+        print '%-10s %14.1f %14.1f' % (name, run(led, pipelined), run(cccd, pipelined))
+
+
+if __name__ == '__main__':
+    main()
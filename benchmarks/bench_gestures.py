@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""Replay a fast wheel spin with occasional button presses through the
+gesture queue, with a handler as slow as a Sonos volume call, and report
+how much of the rotation reached the handler and how many presses were
+lost: the former single-slot MessageHandler versus the coalescing queue.
+
+    python benchmarks/bench_gestures.py [events/s] [handler ms]
+"""
+
+import sys
+import threading
+import time
+
+import fakes
+from nuimo import MessageHandler, sum_values
+
+
+class LegacyMessageHandler(threading.Thread):
+    """The former handler: one slot, polled every 10 ms."""
+    next_msg = None
+
+    def __init__(self):
+        super(LegacyMessageHandler, self).__init__()
+        self.daemon = True
+        self.stop = False
+        self.received = self.merged = self.dropped = 0
+
+    def run(self):
+        while not self.stop:
+            msg = LegacyMessageHandler.next_msg
+            if not msg:
+                time.sleep(0.01)
+                continue
+            if isinstance(msg, tuple):
+                msg[0](*msg[1:])
+            else:
+                msg()
+            LegacyMessageHandler.next_msg = None
+
+    def terminate(self):
+        self.stop = True
+
+    def queue(self, msg, merge=None):
+        self.received += 1
+        if LegacyMessageHandler.next_msg:
+            self.dropped += 1
+            return
+        LegacyMessageHandler.next_msg = msg
+
+
+class Delegate(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.rotation = 0
+        self.presses = 0
+
+    def on_wheel_right(self, value):
+        time.sleep(self.delay)
+        self.rotation += value
+
+    def on_button(self):
+        time.sleep(self.delay)
+        self.presses += 1
+
+
+def replay(handler, rate, delay, events=400, value=8, press_every=50):
+    delegate = Delegate(delay)
+    handler.start()
+    presses = 0
+    for i in range(events):
+        if i % press_every == press_every - 1:
+            handler.queue(delegate.on_button)
+            presses += 1
+        else:
+            handler.queue((delegate.on_wheel_right, value), sum_values)
+        time.sleep(1.0 / rate)
+    time.sleep(delay * 4 + 0.05)
+    handler.terminate()
+    handler.join()
+    sent = (events - presses) * value
+    return (100.0 * delegate.rotation / sent, presses - delegate.presses,
+            handler.received, handler.merged, handler.dropped)
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.03
+    print '%-12s %12s %14s %10s %8s %8s' % ('queue', 'rotation %', 'presses lost', 'received', 'merged', 'dropped')
+    for name, handler in (('single-slot', LegacyMessageHandler()), ('coalescing', MessageHandler())):
+        print '%-12s %12.1f %14d %10d %8d %8d' % ((name,) + replay(handler, rate, delay))
+
+
+if __name__ == '__main__':
+    main()
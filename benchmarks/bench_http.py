@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""Measure per-command SOAP latency against a local stand-in speaker, with
+a new connection per request (plain requests.post, as soco does) versus
+the keep-alive HttpPool. The server can delay every new connection to
+model connection setup on a busy network.
+
+    python benchmarks/bench_http.py [setup delay s] [requests]
+"""
+
+import sys
+import time
+
+import requests
+
+from fakes import FakeSpeakerServer
+from sonos import HttpPool
+
+
+def measure(post, url, count):
+    body = '<s:Envelope><s:Body><u:GetVolume/></s:Body></s:Envelope>'
+    samples = []
+    for _ in range(count):
+        start = time.time()
+        post(url, data=body, headers={'SOAPACTION': 'GetVolume'}).content
+        samples.append(time.time() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.95)] * 1000
+
+
+def main():
+    delay = float(sys.argv[1]) if len(sys.argv) > 1 else 0.005
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    server = FakeSpeakerServer(delay)
+    url = server.url + '/MediaRenderer/RenderingControl/Control'
+
+    pool = HttpPool()
+    print 'connection setup delay %.1f ms, %d requests' % (delay * 1000, count)
+    print '%-14s %12s %12s' % ('client', 'median ms', 'p95 ms')
+    print '%-14s %12.2f %12.2f' % (('per request',) + measure(requests.post, url, count))
+    print '%-14s %12.2f %12.2f' % (('pooled',) + measure(pool.post, url, count))
+    print 'sessions created: %d' % pool.created
+    pool.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""Measure idle CPU use and notification latency of the BLED112 receive
+thread, blocking on the serial device versus polling it with a 1 ms read
+timeout.
+
+    python benchmarks/bench_idle.py [seconds]
+"""
+
+import sys
+import threading
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+HANDLE = 0x10
+
+
+class Delegate(object):
+    def __init__(self):
+        self.received = threading.Event()
+
+    def on_message(self, message):
+        self.received.set()
+
+    def on_disconnect(self):
+        pass
+
+
+def measure(timeout, seconds, samples=50):
+    dongle = VirtualDongle(ADDRESS, radioDelay=0)
+    device = LoopbackSerial(dongle, timeout)
+    com = Bled112Com(serialDevice=device)
+    com.start()
+    try:
+        delegate = Delegate()
+        ble = BleManager(com, ADDRESS, delegate)
+        ble.connect()
+
+        cpu = time.clock()
+        time.sleep(seconds)
+        idle = (time.clock() - cpu) / seconds * 100
+
+        latencies = []
+        for _ in range(samples):
+            delegate.received.clear()
+            start = time.time()
+            device.inject(dongle.notify(HANDLE, [1]))
+            while not delegate.received.is_set():
+                pass
+            latencies.append(time.time() - start)
+            time.sleep(0.01)
+        latencies.sort()
+        return idle, latencies[len(latencies) // 2] * 1e6
+    finally:
+        com.close()
+        com.join()
+        device.close()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print '%-10s %12s %16s' % ('reader', 'idle cpu %', 'p50 latency us')
+    for name, timeout in (('polling', 0.001), ('blocking', None)):
+        print '%-10s %12.2f %16.0f' % ((name,) + measure(timeout, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""Measure LED frame encoding cost: the former per-call string encoding
+versus precompiled led_configs frames and LRU-cached dynamic matrices.
+
+    python benchmarks/bench_led.py [calls]
+"""
+
+import sys
+import time
+
+import fakes
+import led_configs
+from led_configs import LedFrame
+
+
+def legacyEncode(matrix, timeout):
+    matrix = '{:<81}'.format(matrix[:81])
+    bytes = list(map(lambda leds: reduce(lambda acc, led: acc + (1 << led if leds[led] not in [' ', '0'] else 0), range(0, len(leds)), 0), [matrix[i:i+8] for i in range(0, len(matrix), 8)]))
+    return bytes + [max(0, min(255, int(255.0 * 1))), max(0, min(255, int(timeout * 10.0)))]
+
+
+def frameEncode(matrix, timeout):
+    return LedFrame.get(matrix).payload(1, timeout)
+
+
+def measure(encode, matrices, calls):
+    start = time.clock()
+    for i in xrange(calls):
+        encode(matrices[i % len(matrices)], 3)
+    return (time.clock() - start) / calls * 1e6
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frames = [getattr(led_configs, 'vol%d' % i) for i in range(8)]
+    strings = [frame.matrix for frame in frames]
+    assert all(legacyEncode(s, 3) == frameEncode(s, 3) for s in strings)
+    print '%-22s %12s' % ('encoding', 'us/frame')
+    print '%-22s %12.2f' % ('legacy string', measure(legacyEncode, strings, calls))
+    print '%-22s %12.2f' % ('cached string', measure(frameEncode, strings, calls))
+    print '%-22s %12.2f' % ('precompiled frame', measure(frameEncode, frames, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""Replay a fast wheel spin's volume LED updates against a virtual Nuimo
+and report frames sent, estimated radio airtime per frame and in total, and
+the delay until the latest frame was shown, for direct writes and for the LED
+scheduler with and without write responses.
+
+    python benchmarks/bench_led_output.py [seconds] [updates/s]
+"""
+
+import sys
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager
+from nuimo import LedScheduler
+import led_configs
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+LED_HANDLE = 0x1b
+
+# LE 1M PHY: 8 us per byte plus 150 us inter frame space per packet. A write
+# request is answered by a write response in the next connection event.
+PACKET_OVERHEAD = 1 + 4 + 2 + 3 + 4   # preamble, access address, LL header, CRC, L2CAP
+WRITE_BYTES = PACKET_OVERHEAD + 3 + 13
+RESPONSE_BYTES = PACKET_OVERHEAD + 1
+
+
+def airtime(withResponse):
+    us = WRITE_BYTES * 8 + 150
+    if withResponse:
+        us += RESPONSE_BYTES * 8 + 150
+    return us
+
+
+class Direct(object):
+    """The former output path: one acknowledged write per update."""
+    def __init__(self, nuimo):
+        self.nuimo = nuimo
+        self.sent = 0
+        self.without_response = False
+
+    def show(self, frame, timeout):
+        self.sent += 1
+        self.request = self.nuimo.ble.writeAttributeByHandle(LED_HANDLE, frame.payload(1, timeout), False)
+
+    def start(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class VirtualNuimo(object):
+    def __init__(self, ble):
+        self.ble = ble
+        self.characteristics_handles = {'LED_MATRIX': LED_HANDLE}
+
+
+def run(makeOutput, seconds, rate):
+    # Remote events take one 40 ms connection interval, as negotiated
+    dongle = VirtualDongle(ADDRESS, radioDelay=0.04)
+    com = Bled112Com(serialDevice=LoopbackSerial(dongle))
+    com.start()
+    try:
+        ble = BleManager(com, ADDRESS)
+        ble.connect()
+        output = makeOutput(VirtualNuimo(ble))
+        output.start()
+        for i in range(int(seconds * rate)):
+            output.show(getattr(led_configs, 'vol%d' % (i // 4 % 8)), 3)
+            time.sleep(1.0 / rate)
+        last = time.time()
+        output.show(led_configs.play, 3)
+        expected = led_configs.play.payload(1, 3)
+        while not dongle.writes or dongle.writes[-1][1] != expected:
+            time.sleep(0.001)
+        delay = time.time() - last
+        output.terminate()
+        output.join()
+        sent = len(dongle.writes)
+        perFrame = airtime(not output.without_response)
+        return sent, perFrame, sent * perFrame / 1000.0, delay * 1000
+    finally:
+        com.close()
+        com.join()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print '%-18s %8s %18s %18s %18s' % ('output', 'frames', 'airtime us/frame', 'airtime ms total', 'latest delay ms')
+    for name, makeOutput in (('direct', Direct),
+                             ('scheduled', lambda nuimo: LedScheduler(nuimo)),
+                             ('scheduled no-resp', lambda nuimo: LedScheduler(nuimo, True))):
+        print '%-18s %8d %18.0f %18.1f %18.1f' % ((name,) + run(makeOutput, seconds, rate))
+
+
+if __name__ == '__main__':
+    main()
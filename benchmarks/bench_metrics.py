@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""Play random gestures through the end-to-end pipeline of bench_e2e, with
+metrics disabled and enabled, and compare the process CPU time. Also
+times the instrumentation of one gesture on its own and a scrape of the
+endpoint.
+
+    python benchmarks/bench_metrics.py [seconds] [events/s per gesture]
+"""
+
+import os
+import random
+import sys
+import time
+import urllib2
+
+from bench_e2e import GESTURES, CountingController, Probe, TimedEmulator
+from emulator import GesturePlayer
+from fakes import FakeSonos
+from sonos import SonosAPI
+import metrics
+
+
+def cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(enabled, seconds, rate):
+    metrics.enabled = enabled
+    probe = Probe()
+    emulator = TimedEmulator(probe)
+    controller = CountingController(emulator.port, SonosAPI(FakeSonos(1, latency=0.02).players))
+    try:
+        controller.nuimo.connect()
+        random.seed(1)
+        player = GesturePlayer(emulator, dict((name, rate) for name in GESTURES))
+        started, used = time.time(), cpu()
+        player.start()
+        time.sleep(seconds)
+        player.terminate()
+        player.join()
+        time.sleep(0.3)
+        load = (cpu() - used) / (time.time() - started) * 100
+        return load, sum(player.sent.values()), sum(controller.handled.values())
+    finally:
+        controller.shutdown()
+        emulator.close()
+
+
+def instrumentation(count=100000):
+    """Seconds spent per gesture on stamps and the four stage observations."""
+    started = time.time()
+    for _ in range(count):
+        received = time.time()
+        enqueued = time.time()
+        metrics.observe('nuimo_stage_seconds', ('gatt', 'button'), enqueued - received)
+        begun = time.time()
+        metrics.observe('nuimo_stage_seconds', ('queue', 'button'), begun - enqueued)
+        metrics.observe('nuimo_stage_seconds', ('handler', 'button'), time.time() - begun)
+        metrics.observe('sonos_command_seconds', ('play',), time.time() - begun)
+    return (time.time() - started) / count
+
+
+def scrape():
+    server = metrics.serve(0)
+    try:
+        started = time.time()
+        body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.server_port).read()
+        return (time.time() - started) * 1000, len(body.splitlines())
+    finally:
+        server.shutdown()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print '%-10s %8s %8s %10s' % ('metrics', 'CPU %', 'sent', 'handled')
+    for name, enabled in (('disabled', False), ('enabled', True)):
+        print '%-10s %8.2f %8d %10d' % ((name,) + run(enabled, seconds, rate))
+    cost = instrumentation()
+    print 'instrumentation %.1f us per gesture, %.3f%% CPU at %.0f gestures/s' % (
+        cost * 1e6, cost * rate * len(GESTURES) * 100, rate * len(GESTURES))
+    print 'scrape %.1f ms, %d lines' % scrape()
+
+
+if __name__ == '__main__':
+    main()
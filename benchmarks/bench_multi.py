@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""Connect 1-4 virtual Nuimos through one BLED112 and a BleMultiplexer,
+then write LED frames from all of them at once and measure per-device
+write latency and how evenly the devices were served. One link is then
+dropped: the others must keep working and the dropped one reconnect.
+
+    python benchmarks/bench_multi.py [writes per device]
+"""
+
+import sys
+import threading
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager, BleMultiplexer
+
+ADDRESSES = ['A1:B2:C3:D4:E5:%02X' % i for i in range(1, 5)]
+LED_HANDLE = 0x1b
+
+
+def writer(ble, count, samples):
+    for i in range(count):
+        start = time.time()
+        ble.writeAttributeByHandle(LED_HANDLE, [i & 0xFF] * 11 + [255, 30]).result()
+        samples.append(time.time() - start)
+
+
+def reconnect(multiplexer, device, dongle, managers):
+    """Drops the first link and returns the ms until it is back."""
+    dropped = managers[0]
+    device.inject(dongle.drop(dropped.connection.id))
+    start = time.time()
+    while dropped.isConnected():
+        assert time.time() - start < 1, 'drop not reported'
+        time.sleep(0.001)
+    assert multiplexer.com.is_alive(), 'BLED112 thread died'
+    for ble in managers[1:]:
+        assert ble.isConnected(), 'drop reached another device'
+        ble.writeAttributeByHandle(LED_HANDLE, [0] * 11 + [255, 30]).result()
+    dropped.connect()
+    dropped.writeAttributeByHandle(LED_HANDLE, [0] * 11 + [255, 30]).result()
+    return (time.time() - start) * 1000
+
+
+def run(devices, count):
+    dongle = VirtualDongle()
+    device = LoopbackSerial(dongle)
+    multiplexer = BleMultiplexer(Bled112Com(serialDevice=device))
+    multiplexer.start()
+    try:
+        managers = [BleManager(multiplexer.channel(address), address) for address in ADDRESSES[:devices]]
+        for ble in managers:
+            ble.connect()
+        assert len(set(ble.connection.id for ble in managers)) == devices, 'connection ids shared'
+
+        samples = [[] for _ in managers]
+        threads = [threading.Thread(target=writer, args=(ble, count, s)) for ble, s in zip(managers, samples)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        assert len(dongle.writes) == devices * count, 'writes lost'
+
+        means = [sum(s) / len(s) for s in samples]
+        every = sorted(sum(samples, []))
+        return (sum(means) / devices * 1000, every[int(len(every) * 0.95)] * 1000,
+                min(means) / max(means), devices * count / elapsed,
+                reconnect(multiplexer, device, dongle, managers))
+    finally:
+        multiplexer.close()
+        multiplexer.com.join()
+        device.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print '%-8s %12s %12s %10s %12s %14s' % ('nuimos', 'mean ms', 'p95 ms', 'fairness', 'writes/s', 'reconnect ms')
+    for devices in range(1, len(ADDRESSES) + 1):
+        print '%-8d %12.2f %12.2f %10.2f %12.1f %14.2f' % ((devices,) + run(devices, count))
+
+
+if __name__ == '__main__':
+    main()
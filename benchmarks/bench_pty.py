@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""Connect a Nuimo to the BLED112 emulator through a real pty, as
+Bled112Com(serialPort=...) would to the dongle, and measure connect time,
+gesture delivery and notification-to-delegate latency.
+
+    python benchmarks/bench_pty.py [seconds] [events/s per gesture]
+"""
+
+import sys
+import threading
+import time
+
+from emulator import Bled112Emulator, GesturePlayer
+from fakes import MemoryHandleCache
+from bled112 import Bled112Com
+from nuimo import Nuimo, NuimoDelegate
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+GESTURES = ['button', 'swipe_left', 'swipe_right', 'fly_left', 'fly_right', 'rotate_right', 'rotate_left']
+
+
+class Recorder(NuimoDelegate):
+    def __init__(self):
+        NuimoDelegate.__init__(self)
+        self.received = dict((name, 0) for name in GESTURES)
+        self.latencies = []
+        self.last = None
+
+    def record(self, name):
+        self.received[name] += 1
+        if self.last is not None:
+            self.latencies.append(time.time() - self.last)
+
+    def on_button(self): self.record('button')
+    def on_swipe_left(self): self.record('swipe_left')
+    def on_swipe_right(self): self.record('swipe_right')
+    def on_fly_left(self): self.record('fly_left')
+    def on_fly_right(self): self.record('fly_right')
+    def on_wheel_right(self, value): self.record('rotate_right')
+    def on_wheel_left(self, value): self.record('rotate_left')
+
+
+class PtyNuimo(Nuimo):
+    def __init__(self, port, delegate):
+        Nuimo.__init__(self, port, ADDRESS, delegate, MemoryHandleCache())
+
+    def _open_adapter(self):
+        return Bled112Com(serialPort=self.com)
+
+
+def latency(emulator, recorder, samples):
+    """Single button presses, timed from the write to the pty."""
+    for _ in range(samples):
+        count = recorder.received['button']
+        recorder.last = time.time()
+        emulator.gesture('button')
+        while recorder.received['button'] == count:
+            time.sleep(0.0002)
+        time.sleep(0.01)
+    recorder.last = None
+    ordered = sorted(recorder.latencies)
+    return ordered[len(ordered) // 2] * 1000, ordered[int(len(ordered) * 0.99)] * 1000
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    emulator = Bled112Emulator()
+    recorder = Recorder()
+    nuimo = PtyNuimo(emulator.port, recorder)
+    start = time.time()
+    nuimo.connect()
+    print 'connected over %s in %.1f ms' % (emulator.port, (time.time() - start) * 1000)
+
+    print 'button p50 %.2f ms, p99 %.2f ms' % latency(emulator, recorder, 100)
+    recorder.received = dict((name, 0) for name in GESTURES)
+
+    player = GesturePlayer(emulator, dict((name, rate) for name in GESTURES))
+    player.start()
+    time.sleep(seconds)
+    player.terminate()
+    player.join()
+    time.sleep(0.2)
+    print '%-14s %8s %10s' % ('gesture', 'sent', 'delivered')
+    for name in GESTURES:
+        print '%-14s %8d %10d' % (name, player.sent[name], recorder.received[name])
+
+    nuimo.disconnect()
+    nuimo.terminate()
+    emulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+"""Measure Nuimo connect latency against a virtual Nuimo with an empty,
+a valid and a stale handle cache.
+
+    python benchmarks/bench_reconnect.py [rounds]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from fakes import LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from gatt import HandleCache
+from nuimo import HANDLE_SIGNATURE, Nuimo, NuimoDelegate
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+
+
+class VirtualNuimo(Nuimo):
+    def _open_adapter(self):
+        return Bled112Com(serialDevice=LoopbackSerial(VirtualDongle(ADDRESS)))
+
+
+def connect(cache):
+    nuimo = VirtualNuimo(None, ADDRESS, NuimoDelegate(), cache)
+    try:
+        start = time.time()
+        nuimo.connect()
+        return time.time() - start
+    finally:
+        nuimo.bled112.close()
+        nuimo.bled112.join()
+        nuimo.terminate()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'handles.json')
+        cold, warm, stale = [], [], []
+        for _ in range(rounds):
+            cache = HandleCache(path)
+            cache.invalidate(ADDRESS)
+            cold.append(connect(cache))
+            warm.append(connect(HandleCache(path)))
+            handles = dict((name, handle + 1) for name, handle in cache.get(ADDRESS, HANDLE_SIGNATURE).items())
+            cache.put(ADDRESS, HANDLE_SIGNATURE, handles)
+            stale.append(connect(HandleCache(path)))
+        print '%-10s %14s' % ('cache', 'ms/connect')
+        for name, elapsed in (('empty', cold), ('valid', warm), ('stale', stale)):
+            print '%-10s %14.1f' % (name, sum(elapsed) / rounds * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
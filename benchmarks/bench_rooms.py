@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""Run the multi-room controller with 1-4 rooms against virtual Nuimos on
+one BLED112 and stand-in Sonos zones, and report memory, threads and idle
+CPU as rooms are added. Each room count runs in its own process; the last
+column is what one process per room would need.
+
+    python benchmarks/bench_rooms.py [rooms]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ['HOME'] = tempfile.mkdtemp()
+
+from fakes import FakeSonos, LoopbackSerial, VirtualDongle
+from bled112 import Bled112Com
+from controller import MultiRoomController
+
+
+class VirtualRooms(MultiRoomController):
+    def _open_adapter(self, port):
+        return Bled112Com(serialDevice=LoopbackSerial(VirtualDongle()))
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def child(count):
+    FakeSonos([1] * count).install()
+    rooms = [{'nuimo': 'A1:B2:C3:D4:E5:%02X' % (i + 1), 'zone': 'Room %d' % i} for i in range(count)]
+    runtime = VirtualRooms({'adapters': ['virtual'], 'rooms': rooms})
+    runtime.connect()
+    with open(runtime.handle_cache.path) as f:
+        assert len(json.load(f)) == count, 'handle cache lost rooms'
+    time.sleep(0.5)
+    before = os.times()
+    time.sleep(2)
+    after = os.times()
+    cpu = max(0, (after[0] + after[1] - before[0] - before[1]) / (after[4] - before[4]) * 100)
+    print 'usage', rss(), threading.active_count(), cpu, len(runtime.sonos.dispatcher.subscriptions)
+    runtime.shutdown()
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]))
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    print '%-6s %10s %10s %12s %14s %18s' % ('rooms', 'rss kB', 'threads', 'idle cpu %', 'subscriptions',
+                                             'separate rss kB')
+    single = None
+    for rooms in range(1, count + 1):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', str(rooms)])
+        line = next(line for line in output.splitlines() if line.startswith('usage'))
+        memory, threads, cpu, subscriptions = line.split()[1:]
+        single = single or int(memory)
+        print '%-6d %10d %10d %12.2f %14d %18d' % (rooms, int(memory), int(threads), float(cpu),
+                                                   int(subscriptions), single * rooms)
+
+
+if __name__ == '__main__':
+    main()
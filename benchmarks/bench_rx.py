@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""Measure BLED112 receive throughput: frames per second and CPU time per
+frame for the streaming parser versus the former byte-at-a-time reader.
+
+    python benchmarks/bench_rx.py [frames]
+"""
+
+import sys
+import time
+
+from fakes import FakeSerial, notification
+from bled112 import Bled112Com, makeBleMessage
+
+
+class LegacyBled112Com(Bled112Com):
+    """The previous receive path: one byte per read, list of 1-char strings."""
+    def __init__(self, serialDevice):
+        Bled112Com.__init__(self, serialDevice=serialDevice)
+        self.incoming = []
+
+    def readMessages(self):
+        self.incoming.extend(self.serialDevice.read())
+        if len(self.incoming) < self.HEADER_SIZE: return []
+        payloadLength = ord(self.incoming[self.PAYLOAD_LENGTH_OFFSET])
+        if self.HEADER_SIZE + payloadLength > len(self.incoming): return []
+        header = map(ord, self.incoming[0:self.HEADER_SIZE])
+        del self.incoming[0:self.HEADER_SIZE]
+        payload = []
+        if payloadLength:
+            payload = map(ord, self.incoming[0:payloadLength])
+            del self.incoming[0:payloadLength]
+        return [makeBleMessage(bytearray(header + payload))]
+
+
+def run(comClass, stream, frames):
+    device = FakeSerial(stream)
+    com = comClass(serialDevice=device)
+    received = 0
+    wall = time.time()
+    cpu = time.clock()
+    while not device.exhausted() or received < frames:
+        received += len(com.readMessages())
+    cpu = time.clock() - cpu
+    wall = time.time() - wall
+    assert received == frames
+    return frames / wall, cpu / frames * 1e6
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    stream = b''.join(notification(0, 0x1d, [i & 0xFF, 0]) for i in range(frames))
+    print '%-10s %14s %14s' % ('reader', 'frames/s', 'cpu us/frame')
+    for name, comClass in (('legacy', LegacyBled112Com), ('streaming', Bled112Com)):
+        rate, cpu = run(comClass, stream, frames)
+        print '%-10s %14.0f %14.2f' % (name, rate, cpu)
+
+
+if __name__ == '__main__':
+    main()
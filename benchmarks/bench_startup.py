@@ -0,0 +1,44 @@
+#!/usr/bin/python
+"""Measure SonosAPI startup without a topology cache (cold, waiting for
+discovery) and with one (warm), and how long a ZoneGroupTopology event
+takes to update the groups in place.
+
+    python benchmarks/bench_startup.py [discovery s] [players]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from fakes import FakeSonos
+from sonos import SonosAPI, TopologyCache
+
+
+def main():
+    delay = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    system = FakeSonos(count, discovery_delay=delay).install()
+    path = os.path.join(tempfile.mkdtemp(), 'sonos.json')
+
+    print '%-8s %12s %10s' % ('startup', 'ms', 'players')
+    for name in ('cold', 'warm'):
+        sonos = SonosAPI(topology_cache=TopologyCache(path))
+        print '%-8s %12.1f %10d' % (name, sonos.startup_time * 1000, len(sonos.players))
+        if name == 'cold':
+            sonos.disconnect()
+
+    # A room leaves the group: the topology event alone updates groups and cache
+    leaving = system.players[-1]
+    start = time.time()
+    system.setGroup([leaving])
+    while sonos.groups[leaving.player_name][0] is not leaving or \
+            not any(entry['group'] == leaving.uid for entry in TopologyCache(path).get()):
+        time.sleep(0.001)
+    print 'topology event applied in %.1f ms, %s now leads its own group' % (
+        (time.time() - start) * 1000, leaving.player_name)
+    sonos.disconnect()
+
+
+if __name__ == '__main__':
+    main()
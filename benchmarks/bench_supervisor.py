@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""Drop the link of a virtual Nuimo repeatedly and measure time-to-ready,
+adapters opened and threads alive: the former recursive on_disconnect
+versus the ConnectionSupervisor. A second run leaves connection attempts
+unanswered to show the backoff.
+
+    python benchmarks/bench_supervisor.py [drops]
+"""
+
+import sys
+import threading
+import time
+
+from fakes import LoopbackSerial, MemoryHandleCache, VirtualDongle
+from bled112 import Bled112Com
+from gatt import BleManager
+from nuimo import Nuimo, NuimoDelegate
+
+ADDRESS = 'A1:B2:C3:D4:E5:F6'
+
+
+class Delegate(NuimoDelegate):
+    def __init__(self):
+        NuimoDelegate.__init__(self)
+        self.connected = threading.Event()
+
+    def on_connect(self):
+        self.connected.set()
+
+
+class VirtualNuimo(Nuimo):
+    def __init__(self, dongle, cache):
+        Nuimo.__init__(self, None, ADDRESS, Delegate(), cache)
+        self.dongle = dongle
+        self.serial = None
+        self.adapters = 0
+
+    def _open_adapter(self):
+        self.adapters += 1
+        self.serial = LoopbackSerial(self.dongle)
+        return Bled112Com(serialDevice=self.serial)
+
+
+class LegacyNuimo(VirtualNuimo):
+    """The former reconnect: close, sleep 5 s, open a new adapter."""
+    def connect(self):
+        self.bled112 = self._open_adapter()
+        self.bled112.start()
+        self.ble = BleManager(self.bled112, self.address, self)
+        while not self.ble.isConnected():
+            self.ble.connect()
+            self._setup_connection()
+            self.delegate.on_connect()
+
+    def on_disconnect(self):
+        self.bled112.close()
+        time.sleep(5)
+        self.connect()
+
+
+def drop(nuimo, count, refuse=0):
+    samples = []
+    for _ in range(count):
+        nuimo.delegate.connected.clear()
+        nuimo.dongle.refuse = refuse
+        start = time.time()
+        nuimo.serial.inject(nuimo.dongle.drop())
+        nuimo.delegate.connected.wait()
+        samples.append(time.time() - start)
+    return samples
+
+
+def run(nuimoClass, drops, refuse=0):
+    nuimo = nuimoClass(VirtualDongle(ADDRESS), MemoryHandleCache())
+    nuimo.connect()
+    nuimo.delegate.connected.wait()
+    if nuimoClass is not LegacyNuimo:
+        nuimo.ble.remoteTimeout = 0.2
+    threads = threading.active_count()
+    samples = drop(nuimo, drops, refuse)
+    grown = threading.active_count() - threads
+    if nuimoClass is not LegacyNuimo:
+        assert nuimo.supervisor.reconnects == drops, 'failed attempts counted as reconnects'
+    if nuimoClass is LegacyNuimo:
+        nuimo.bled112.close()
+    else:
+        nuimo.disconnect()
+    nuimo.terminate()
+    return sum(samples) / len(samples) * 1000, max(samples) * 1000, nuimo.adapters, grown
+
+
+def main():
+    drops = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print '%-22s %12s %12s %10s %14s' % ('reconnect', 'mean ms', 'max ms', 'adapters', 'extra threads')
+    row = '%-22s %12.1f %12.1f %10d %14d'
+    print row % (('recursive (2 drops)',) + run(LegacyNuimo, 2))
+    print row % (('supervisor',) + run(VirtualNuimo, drops))
+    print row % (('supervisor, 4 refused',) + run(VirtualNuimo, 3, refuse=4))
+
+
+if __name__ == '__main__':
+    main()
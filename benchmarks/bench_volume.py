@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""Spin the wheel against stand-in Sonos players and count Sonos requests:
+the former handling, which read the volume, wrote it to every player and
+read it back for each wheel event, versus the windowed VolumeAggregator.
+Both get the same events. Also reports the volume reads SonosAPI answered
+from its local model and how stale that was at the end.
+
+    python benchmarks/bench_volume.py [events/s] [seconds] [players]
+"""
+
+import sys
+import time
+
+from fakes import FakeSonos
+from controller import NuimoSonosController, VolumeAggregator
+from nuimo import MessageHandler, sum_values
+from sonos import SonosAPI
+
+
+class Direct(object):
+    """The former wheel handling, per event: vol_up() read the coordinator's
+    volume and _set_volume() wrote the sum to each player in turn, then
+    _show_volume() read it back through get_volume().
+    """
+    merge = None
+
+    def __init__(self, sonos):
+        self.coordinator = sonos.coordinator
+        self.players = sonos.players
+
+    def on_wheel_right(self, value):
+        volume = self.coordinator.volume + NuimoSonosController._calculate_volume_delta(value)
+        for player in self.players:
+            player.volume = volume
+        self.coordinator.volume
+
+
+class Aggregated(object):
+    merge = staticmethod(sum_values)
+
+    def __init__(self, sonos):
+        self.aggregator = VolumeAggregator(sonos, lambda volume: None)
+        self.aggregator.start()
+
+    def on_wheel_right(self, value):
+        self.aggregator.add(NuimoSonosController._calculate_volume_delta(value))
+
+
+def spin(makeHandler, rate, seconds, count):
+    players = FakeSonos(count, volume=0).players
+    sonos = SonosAPI(players)
+    handler = makeHandler(sonos)
+    queue = MessageHandler()
+    queue.start()
+    start = time.time()
+    events = 0
+    while time.time() - start < seconds:
+        queue.queue((handler.on_wheel_right, 4), handler.merge)
+        events += 1
+        time.sleep(1.0 / rate)
+    while queue.messages:
+        time.sleep(0.01)
+    time.sleep(0.3)
+    elapsed = time.time() - start
+    queue.terminate()
+    sonos.disconnect()
+    requests = sum(player.calls for player in players)
+    return (events, requests, requests / elapsed, players[0]._volume,
+            sonos.volume_reads, sonos.volume_reads_avoided, sonos.volume_staleness())
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    print '%-12s %8s %10s %12s %12s %14s %14s %12s' % ('wheel', 'events', 'requests', 'requests/s', 'end volume',
+                                                       'network reads', 'reads avoided', 'staleness s')
+    requests = []
+    for name, makeHandler in (('per-event', Direct), ('aggregated', Aggregated)):
+        result = spin(makeHandler, rate, seconds, count)
+        requests.append(result[1])
+        print '%-12s %8d %10d %12.1f %12d %14d %14d %12.2f' % ((name,) + result)
+    print 'requests per wheel event cut %.1fx' % (requests[0] / float(requests[1]))
+    print 'the deltas of %d events sum to %.1f; the former path truncated each one' % (
+        result[0], min(100, result[0] * NuimoSonosController._calculate_volume_delta(4)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""BLED112 emulator on a pseudo-terminal. It answers the BGAPI commands
+bled112.py sends with a VirtualDongle holding a virtual Nuimo, and plays
+gestures as notifications, so that Bled112Com(serialPort=emulator.port)
+or controller.py run without hardware.
+
+    python benchmarks/emulator.py [gesture=rate ...] [--script file]
+
+Rates are events per second, e.g. rotate_right=20 button=0.5. A script
+has one "seconds gesture [value]" line per event, with seconds counted
+from the first connection. Gesture names are those of NUIMO_GESTURES;
+"button" is a press followed by a release.
+"""
+
+import os
+import pty
+import random
+import sys
+import threading
+import time
+import tty
+
+from fakes import NUIMO_GESTURES, LoopbackSerial, VirtualDongle
+
+
+class Bled112Emulator(LoopbackSerial):
+    """LoopbackSerial whose other end is the slave side of a pty."""
+
+    def __init__(self, dongle=None):
+        LoopbackSerial.__init__(self, dongle or VirtualDongle())
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.reader = threading.Thread(target=self.read_commands)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_commands(self):
+        while not self.closed:
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                break
+            if not data:
+                break
+            self.write(data)
+
+    def emit(self, data):
+        os.write(self.master, data)
+
+    def gesture(self, name, value=None):
+        """Send a gesture now. Returns False if it could not be delivered
+        because nothing is connected or subscribed to it.
+        """
+        if name == 'button':
+            return self.gesture('button_press') and self.gesture('button_release')
+        data = self.dongle.gesture(name, value)
+        if data is None:
+            return False
+        self.inject(data)
+        return True
+
+    def close(self):
+        LoopbackSerial.close(self)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class GesturePlayer(threading.Thread):
+    """Plays gestures on an emulator, either from a script of
+    (seconds, name, value) tuples or at random with the given rates in
+    events per second. Gestures wait until the Nuimo is subscribed.
+    """
+
+    def __init__(self, emulator, rates=None, script=None):
+        super(GesturePlayer, self).__init__()
+        self.daemon = True
+        self.emulator = emulator
+        self.rates = rates or {}
+        self.script = sorted(script or [])
+        self.stop = threading.Event()
+        self.sent = dict((name, 0) for name in NUIMO_GESTURES)
+        self.sent['button'] = 0
+
+    def run(self):
+        while not self.emulator.dongle.subscribed and not self.stop.is_set():
+            self.stop.wait(0.05)
+        start = time.time()
+        for at, name, value in self.events():
+            delay = start + at - time.time()
+            if delay > 0:
+                self.stop.wait(delay)
+            if self.stop.is_set():
+                break
+            if self.emulator.gesture(name, value):
+                self.sent[name] += 1
+
+    def events(self):
+        """Script events, or an endless merge of one Poisson stream per rate."""
+        if self.script:
+            return iter(self.script)
+        return self.random_events()
+
+    def random_events(self):
+        upcoming = [(random.expovariate(rate), name) for name, rate in self.rates.items() if rate > 0]
+        while upcoming:
+            upcoming.sort()
+            at, name = upcoming[0]
+            value = random.randint(1, 60) if name.startswith('rotate') else None
+            yield at, name, value
+            upcoming[0] = (at + random.expovariate(self.rates[name]), name)
+
+    def terminate(self):
+        self.stop.set()
+
+
+def parse_script(path):
+    script = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                value = int(fields[2]) if len(fields) > 2 else None
+                script.append((float(fields[0]), fields[1], value))
+    return script
+
+
+def main():
+    rates, script = {}, None
+    arguments = sys.argv[1:]
+    while arguments:
+        argument = arguments.pop(0)
+        if argument == '--script':
+            script = parse_script(arguments.pop(0))
+        else:
+            name, rate = argument.split('=')
+            rates[name] = float(rate)
+
+    emulator = Bled112Emulator()
+    player = GesturePlayer(emulator, rates, script)
+    player.start()
+    print 'BLED112 emulator on %s' % emulator.port
+    try:
+        while player.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    player.terminate()
+    emulator.close()
+    print 'sent: %s' % ', '.join('%s %d' % item for item in sorted(player.sent.items()) if item[1])
+
+
+if __name__ == '__main__':
+    main()
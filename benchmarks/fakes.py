@@ -0,0 +1,597 @@
+"""Hardware-free stand-ins shared by the benchmark scripts."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import Queue
+import heapq
+import random
+import struct
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from gatt import HandleCache
+
+
+def frame(header, payload=()):
+    """Encode a raw BGAPI frame, filling in the payload length."""
+    return struct.pack('4B', header[0], len(payload), header[2], header[3]) + \
+        struct.pack('%dB' % len(payload), *payload)
+
+
+def notification(connection, handle, data):
+    """Encode an attclient_attribute_value event as sent for a notification."""
+    payload = [connection, handle & 0xFF, handle >> 8, 1, len(data)] + list(data)
+    return frame((0x80, 0, 0x04, 0x05), payload)
+
+
+class FakeSerial(object):
+    """Serial device replaying a fixed byte stream.
+
+    Data becomes available in chunks of `chunk` bytes, like the 64 byte bulk
+    packets of the BLED112 USB CDC interface.
+    """
+    def __init__(self, data, chunk=64):
+        self.data = data
+        self.chunk = chunk
+        self.position = 0
+        self.written = []
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data) - self.position)
+
+    def read(self, size=1):
+        data = self.data[self.position:self.position + min(size, self.in_waiting)]
+        self.position += len(data)
+        return data
+
+    def write(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def exhausted(self):
+        return self.position >= len(self.data)
+
+
+def uuidBytes(uuid):
+    """Little endian byte list of a 16 or 128 bit UUID string."""
+    return list(reversed(bytearray.fromhex(uuid.replace('-', ''))))
+
+
+def nuimoGattTable():
+    """Attribute table of a virtual Nuimo as (handle, type uuid, service uuid)
+    tuples, laid out like the real device: service declaration, then
+    characteristic declaration, value and CCCD per characteristic.
+    """
+    services = [
+        ('1800', ['2a00', '2a01']),
+        ('180f', ['2a19']),
+        ('f29b1525-cb19-40f3-be5c-7241ecb82fd2', [
+            'f29b1529-cb19-40f3-be5c-7241ecb82fd2',
+            'f29b1528-cb19-40f3-be5c-7241ecb82fd2',
+            'f29b1527-cb19-40f3-be5c-7241ecb82fd2',
+            'f29b1526-cb19-40f3-be5c-7241ecb82fd2']),
+        ('f29b1523-cb19-40f3-be5c-7241ecb82fd1', ['f29b1524-cb19-40f3-be5c-7241ecb82fd1']),
+    ]
+    table = []
+    handle = 1
+    for service, characteristics in services:
+        table.append((handle, '2800', service))
+        handle += 1
+        for uuid in characteristics:
+            table.extend([(handle, '2803', service), (handle + 1, uuid, service), (handle + 2, '2902', service)])
+            handle += 3
+    return table
+
+
+# Characteristic and value encoding per gesture, as sent by the Nuimo
+NUIMO_GESTURES = {
+    'battery': ('2a19', lambda level: [int((100 if level is None else level) * 255 / 100)]),
+    'button_press': ('f29b1529-cb19-40f3-be5c-7241ecb82fd2', lambda value: [1]),
+    'button_release': ('f29b1529-cb19-40f3-be5c-7241ecb82fd2', lambda value: [0]),
+    'swipe_left': ('f29b1527-cb19-40f3-be5c-7241ecb82fd2', lambda value: [0]),
+    'swipe_right': ('f29b1527-cb19-40f3-be5c-7241ecb82fd2', lambda value: [1]),
+    'swipe_up': ('f29b1527-cb19-40f3-be5c-7241ecb82fd2', lambda value: [2]),
+    'swipe_down': ('f29b1527-cb19-40f3-be5c-7241ecb82fd2', lambda value: [3]),
+    'rotate_right': ('f29b1528-cb19-40f3-be5c-7241ecb82fd2', lambda value: [value or 10, 0]),
+    'rotate_left': ('f29b1528-cb19-40f3-be5c-7241ecb82fd2', lambda value: [255 - (value or 10), 0xFF]),
+    'fly_left': ('f29b1526-cb19-40f3-be5c-7241ecb82fd2', lambda value: [0, 0]),
+    'fly_right': ('f29b1526-cb19-40f3-be5c-7241ecb82fd2', lambda value: [1, 0]),
+    'fly_towards': ('f29b1526-cb19-40f3-be5c-7241ecb82fd2', lambda value: [2, 0]),
+    'fly_backwards': ('f29b1526-cb19-40f3-be5c-7241ecb82fd2', lambda value: [3, 0]),
+    'fly_height': ('f29b1526-cb19-40f3-be5c-7241ecb82fd2', lambda value: [4, value or 0]),
+}
+
+
+class VirtualDongle(object):
+    """BLED112 with virtual Nuimos in range, answering BGAPI commands. Every
+address connected to gets its own connection id and the same GATT table.
+
+    handle() takes a command frame and returns (delay, frame) replies, each
+    delivered `delay` seconds after the one before it. Local responses come
+    without delay, events from the remote device after about `radioDelay`.
+    """
+    def __init__(self, address=None, radioDelay=0.0075):
+        self.address = address
+        self.radioDelay = radioDelay
+        self.table = nuimoGattTable()
+        self.connection = None
+        self.connections = {}
+        self.writes = []
+        self.subscribed = set()
+        self.refuse = 0
+        self.connecting = False
+
+    def handle(self, data):
+        data = bytearray(data)
+        key = (data[2], data[3])
+        payload = data[4:]
+        handler = {
+            (0x06, 0x03): self.connectDirect,
+            (0x06, 0x04): self.endProcedure,
+            (0x03, 0x00): self.disconnect,
+            (0x04, 0x01): self.readByGroupType,
+            (0x04, 0x03): self.findInformation,
+            (0x04, 0x05): self.attributeWrite,
+            (0x04, 0x06): self.writeCommand,
+            (0x00, 0x00): self.reset,
+        }.get(key)
+        return handler(payload) if handler else []
+
+    def response(self, command, payload):
+        return (0, frame((0x00, 0, command[0], command[1]), payload))
+
+    def event(self, delay, command, payload):
+        return (delay, frame((0x80, 0, command[0], command[1]), payload))
+
+    def completed(self, delay, connection, handle=0, result=0):
+        return self.event(delay, (0x04, 0x01), [connection, result & 0xFF, result >> 8, handle & 0xFF, handle >> 8])
+
+    def connectDirect(self, payload):
+        if self.connecting:
+            # Device in wrong state: the last attempt was not ended
+            return [self.response((0x06, 0x03), [0x81, 0x01, 0])]
+        if self.refuse:
+            # Out of range: the connection attempt never completes
+            self.refuse -= 1
+            self.connecting = True
+            return [self.response((0x06, 0x03), [0, 0, 0])]
+        address = tuple(payload[0:6])
+        if address not in self.connections:
+            used = set(self.connections.values())
+            self.connections[address] = min(i for i in range(8) if i not in used)
+        self.connection = self.connections[address]
+        status = [self.connection, 0x05] + list(payload[0:7]) + [32, 0, 100, 0, 0, 0, 0xFF]
+        return [self.response((0x06, 0x03), [0, 0, self.connection]),
+                self.event(self.radioDelay, (0x03, 0x00), status)]
+
+    def endProcedure(self, payload):
+        result = [0, 0] if self.connecting else [0x81, 0x01]
+        self.connecting = False
+        return [self.response((0x06, 0x04), result)]
+
+    def disconnect(self, payload):
+        replies = [self.response((0x03, 0x00), [payload[0], 0, 0]),
+                   self.event(self.radioDelay, (0x03, 0x04), [payload[0], 0x16, 0x02])]
+        self.forget(payload[0])
+        return replies
+
+    def reset(self, payload):
+        self.connection = None
+        self.connecting = False
+        self.connections = {}
+        self.subscribed = set()
+        return []
+
+    def forget(self, connection):
+        for address, id in self.connections.items():
+            if id == connection:
+                del self.connections[address]
+        if connection == self.connection:
+            self.connection = None
+        self.subscribed = set((c, h) for c, h in self.subscribed if c != connection)
+
+    def readByGroupType(self, payload):
+        replies = [self.response((0x04, 0x01), [payload[0], 0, 0])]
+        services = [entry for entry in self.table if entry[1] == '2800']
+        ends = [entry[0] - 1 for entry in services[1:]] + [self.table[-1][0]]
+        for (start, _, uuid), end in zip(services, ends):
+            raw = uuidBytes(uuid)
+            replies.append(self.event(self.radioDelay, (0x04, 0x02),
+                                      [payload[0], start & 0xFF, start >> 8, end & 0xFF, end >> 8, len(raw)] + raw))
+        replies.append(self.completed(self.radioDelay, payload[0]))
+        return replies
+
+    def findInformation(self, payload):
+        start = payload[1] + payload[2] * 256
+        end = payload[3] + payload[4] * 256
+        replies = [self.response((0x04, 0x03), [payload[0], 0, 0])]
+        for handle, uuid, _ in self.table:
+            if start <= handle <= end:
+                raw = uuidBytes(uuid)
+                replies.append(self.event(self.radioDelay / 4, (0x04, 0x04),
+                                          [payload[0], handle & 0xFF, handle >> 8, len(raw)] + raw))
+        replies.append(self.completed(self.radioDelay, payload[0]))
+        return replies
+
+    def attributeWrite(self, payload):
+        handle = payload[1] + payload[2] * 256
+        self.writes.append((handle, list(payload[4:])))
+        # Write not permitted to anything but characteristic values and CCCDs
+        writable = any(h == handle and uuid not in ('2800', '2803') for h, uuid, _ in self.table)
+        if any(h == handle and uuid == '2902' for h, uuid, _ in self.table):
+            if len(payload) > 4 and payload[4] & 1:
+                self.subscribed.add((payload[0], handle - 1))
+            else:
+                self.subscribed.discard((payload[0], handle - 1))
+        return [self.response((0x04, 0x05), [payload[0], 0, 0]),
+                self.completed(self.radioDelay, payload[0], handle, 0 if writable else 0x0403)]
+
+    def writeCommand(self, payload):
+        handle = payload[1] + payload[2] * 256
+        self.writes.append((handle, list(payload[4:])))
+        return [self.response((0x04, 0x06), [payload[0], 0, 0])]
+
+    def drop(self, connection=None):
+        """Disconnected event as sent after a supervision timeout."""
+        connection = self.connection if connection is None else connection
+        self.forget(connection)
+        return frame((0x80, 0, 0x03, 0x04), [connection, 0x08, 0x02])
+
+    def valueHandle(self, uuid):
+        return next(h for h, type, _ in self.table if type == uuid)
+
+    def gesture(self, name, value=None, connection=None):
+        """Notification frame for a Nuimo gesture, or None if the client has
+        not enabled notifications for it.
+        """
+        uuid, encode = NUIMO_GESTURES[name]
+        handle = self.valueHandle(uuid)
+        connection = self.connection if connection is None else connection
+        if (connection, handle) not in self.subscribed:
+            return None
+        return self.notify(handle, encode(value), connection)
+
+    def notify(self, handle, data, connection=None):
+        connection = self.connection if connection is None else connection
+        return frame((0x80, 0, 0x04, 0x05), [connection, handle & 0xFF, handle >> 8, 1, len(data)] + list(data))
+
+
+class MemoryHandleCache(HandleCache):
+    """HandleCache that starts empty and is never saved."""
+    def __init__(self):
+        HandleCache.__init__(self, os.devnull)
+
+    def save(self):
+        pass
+
+
+class LoopbackSerial(object):
+    """Serial device connected to a VirtualDongle. Written command frames are
+    answered on a delivery thread that honours each reply's delay.
+    """
+    def __init__(self, dongle, timeout=None):
+        self.dongle = dongle
+        self.timeout = timeout
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.pending = []
+        self.sequence = 0
+        self.ready = threading.Condition()
+        self.closed = False
+        self.cancelled = False
+        self.deliverer = threading.Thread(target=self.deliver)
+        self.deliverer.daemon = True
+        self.deliverer.start()
+
+    @property
+    def in_waiting(self):
+        return len(self.incoming)
+
+    def read(self, size=1):
+        with self.ready:
+            if not self.incoming and not self.cancelled:
+                self.ready.wait(self.timeout)
+            self.cancelled = False
+            data = bytes(self.incoming[:size])
+            del self.incoming[:size]
+            return data
+
+    def cancel_read(self):
+        with self.ready:
+            self.cancelled = True
+            self.ready.notify_all()
+
+    def write(self, data):
+        self.outgoing.extend(data)
+        while len(self.outgoing) >= 4 and len(self.outgoing) >= 4 + self.outgoing[1]:
+            size = 4 + self.outgoing[1]
+            command = self.outgoing[:size]
+            del self.outgoing[:size]
+            self.schedule(self.dongle.handle(command))
+
+    def inject(self, data, delay=0):
+        """Deliver raw frame bytes to the reader, e.g. a notification."""
+        self.schedule([(delay, data)])
+
+    def schedule(self, replies):
+        now = time.time()
+        with self.ready:
+            offset = 0
+            for delay, data in replies:
+                offset += delay
+                self.sequence += 1
+                heapq.heappush(self.pending, (now + offset, self.sequence, data))
+            self.ready.notify_all()
+
+    def deliver(self):
+        while not self.closed:
+            with self.ready:
+                if not self.pending:
+                    self.ready.wait()
+                    continue
+                due, _, data = self.pending[0]
+                if due <= time.time():
+                    heapq.heappop(self.pending)
+                    self.emit(data)
+                    continue
+            time.sleep(min(0.0005, max(0, due - time.time())))
+
+    def emit(self, data):
+        """Hand a due reply to the reader. Called with self.ready held."""
+        self.incoming.extend(data)
+        self.ready.notify_all()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+class FakeSubscription(object):
+    def __init__(self, service, event_queue=None):
+        self.service = service
+        self.events = Queue.Queue() if event_queue is None else event_queue
+
+    def unsubscribe(self):
+        if self in self.service.subscriptions:
+            self.service.subscriptions.remove(self)
+
+
+class FakeService(object):
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, requested_timeout=None, auto_renew=False, event_queue=None):
+        subscription = FakeSubscription(self, event_queue)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def emit(self, event, delay=0):
+        """Send event to all subscribers, after delay seconds if given."""
+        if delay:
+            timer = threading.Timer(delay, self.emit, [event])
+            timer.daemon = True
+            timer.start()
+            return
+        event.service = self
+        for subscription in list(self.subscriptions):
+            subscription.events.put(event)
+
+
+class FakeEvent(object):
+    def __init__(self, **variables):
+        self.variables = variables
+        self.__dict__.update(variables)
+
+
+class FakeGroup(object):
+    def __init__(self, coordinator, members=None):
+        self.coordinator = coordinator
+        self.members = members or [coordinator]
+
+
+class FakeUPnPError(Exception):
+    pass
+
+
+class FakePlayer(object):
+    """Sonos player stand-in. Network calls take `latency` plus up to
+    `jitter` seconds, fail with probability `failure_rate` and are counted
+    in `calls`. Transport and volume changes are reported to subscribers
+    `event_delay` seconds later, as the speaker would. on_change, if set, is
+    called as on_change(player, what) once a command took effect.
+    """
+    def __init__(self, name='Living Room', is_coordinator=True, latency=0.02, volume=20, ip='10.0.0.1',
+                 jitter=0.0, failure_rate=0.0, event_delay=0.0):
+        self.player_name = name
+        self.is_coordinator = is_coordinator
+        self.ip_address = ip
+        self.uid = 'RINCON_%08X1400' % struct.unpack('>I', ''.join(chr(int(b)) for b in ip.split('.')))[0]
+        self.group = None
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.event_delay = event_delay
+        self.calls = 0
+        self.failures = 0
+        self.on_change = None
+        self._volume = volume
+        self.transport_state = 'STOPPED'
+        self.avTransport = FakeService()
+        self.renderingControl = FakeService()
+        self.zoneGroupTopology = FakeService()
+
+    def call(self):
+        self.calls += 1
+        time.sleep(self.latency + (random.uniform(0, self.jitter) if self.jitter else 0))
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures += 1
+            raise FakeUPnPError('UPnP Error 701 received: Transition not available from %s' % self.player_name)
+
+    def changed(self, what):
+        if self.on_change:
+            self.on_change(self, what)
+
+    @property
+    def volume(self):
+        self.call()
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self.call()
+        self._volume = int(value)
+        self.changed('volume')
+        self.renderingControl.emit(FakeEvent(volume={'Master': str(self._volume)}), self.event_delay)
+
+    def transition(self, state):
+        self.call()
+        self.transport_state = state
+        self.changed(state)
+        self.avTransport.emit(FakeEvent(transport_state=state), self.event_delay)
+
+    def play(self):
+        self.transition('PLAYING')
+
+    def pause(self):
+        self.transition('PAUSED_PLAYBACK')
+
+    def next(self):
+        self.call()
+        self.changed('next')
+
+    def previous(self):
+        self.call()
+        self.changed('previous')
+
+
+class FakeSonos(object):
+    """In-process Sonos system for SonosAPI: players in groups, answering
+    soco.discover() and soco.SoCo(ip) once installed. groups is a player
+    count for a single group or a list of group sizes; the first player of
+    each group is its coordinator. Further keyword arguments configure
+    every FakePlayer.
+    """
+    def __init__(self, groups=1, discovery_delay=0.0, **options):
+        self.discovery_delay = discovery_delay
+        self.players = []
+        self.groups = []
+        for size in ([groups] if isinstance(groups, int) else groups):
+            members = []
+            for _ in range(size):
+                index = len(self.players)
+                player = FakePlayer('Room %d' % index, not members, ip='10.0.0.%d' % (index + 1), **options)
+                self.players.append(player)
+                members.append(player)
+            self.setGroup(members)
+        self.saved = None
+
+    def setGroup(self, members):
+        """Make members one group led by the first, and announce the new
+        topology as a ZoneGroupTopology event.
+        """
+        for other in self.groups:
+            other.members = [player for player in other.members if player not in members]
+            if other.members and other.coordinator not in other.members:
+                other.coordinator = other.members[0]
+        self.groups = [other for other in self.groups if other.members] + [FakeGroup(members[0], members)]
+        for group in self.groups:
+            for player in group.members:
+                player.group = group
+                player.is_coordinator = player is group.coordinator
+        state = self.zoneGroupState()
+        for player in self.players:
+            player.zoneGroupTopology.emit(FakeEvent(zone_group_state=state), player.event_delay)
+
+    def zoneGroupState(self):
+        member = ('<ZoneGroupMember UUID="%s" Location="http://%s:1400/xml/device_description.xml" '
+                  'ZoneName="%s"/>')
+        groups = ''.join('<ZoneGroup Coordinator="%s" ID="%s:1">%s</ZoneGroup>' % (
+            group.coordinator.uid, group.coordinator.uid,
+            ''.join(member % (p.uid, p.ip_address, p.player_name) for p in group.members))
+            for group in self.groups)
+        return '<ZoneGroups>%s</ZoneGroups>' % groups
+
+    def discover(self, timeout=5, **kwargs):
+        time.sleep(self.discovery_delay)
+        return set(self.players)
+
+    def SoCo(self, ip):
+        return next(player for player in self.players if player.ip_address == ip)
+
+    def install(self):
+        """Answer soco.discover() and soco.SoCo() until uninstall()."""
+        import soco
+        self.saved = (soco.discover, soco.SoCo)
+        soco.discover = self.discover
+        soco.SoCo = self.SoCo
+        return self
+
+    def uninstall(self):
+        import soco
+        if self.saved:
+            soco.discover, soco.SoCo = self.saved
+            self.saved = None
+
+    @property
+    def calls(self):
+        return sum(player.calls for player in self.players)
+
+
+SOAP_RESPONSE = ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+                 '<u:GetVolumeResponse xmlns:u="urn:schemas-upnp-org:service:RenderingControl:1">'
+                 '<CurrentVolume>20</CurrentVolume></u:GetVolumeResponse></s:Body></s:Envelope>')
+
+
+class SoapHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        time.sleep(self.server.setup_delay)
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(SOAP_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(SOAP_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSpeakerServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP/1.1 server answering every POST with a SOAP response.
+    Each new connection is delayed by setup_delay seconds to model
+    connection setup on a busy network.
+    """
+    daemon_threads = True
+
+    def __init__(self, setup_delay=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SoapHandler)
+        self.setup_delay = setup_delay
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -39,9 +39,14 @@ import serial
 import struct
 import logging
 
+import metrics
+
 # Set to 1 to enable debug prints of raw UART messages
 DEBUG = 0
 
+# Size of the BGAPI header preceding every payload
+HEADER_SIZE = 4
+
 
 def makeUuidFromArray(uint8array):
     uuid = ''
@@ -91,12 +96,65 @@ class Uint8Array:
                 raise RuntimeError()
         return self.array
 
-class BleMessage:
+# Incoming message classes by messageKey(), filled in by @incoming
+messageIndex = {}
+
+def messageKey(header):
+    """Pack the identifying header bytes (message type, class and command)
+    into one integer, leaving out the payload length.
+    """
+    return header[0] << 16 | header[2] << 8 | header[3]
+
+def incoming(cls):
+    """Class decorator registering a message class with makeBleMessage."""
+    messageIndex[messageKey(cls.HEADER)] = cls
+    return cls
+
+class Field(object):
+    """Payload field of an incoming message, decoded from the raw frame with
+    struct whenever it is accessed.
+    """
+    __slots__ = ('struct', 'offset')
+
+    def __init__(self, fmt, offset):
+        self.struct = struct.Struct('<' + fmt)
+        self.offset = HEADER_SIZE + offset
+
+    def __get__(self, message, cls):
+        if message is None: return self
+        return self.struct.unpack_from(message.frame, self.offset)[0]
+
+class ArrayField(object):
+    """Length-prefixed uint8array field. Returns a bytearray of the elements,
+    or the result of `decode` applied to them.
+    """
+    __slots__ = ('offset', 'decode')
+
+    def __init__(self, offset, decode=None):
+        self.offset = HEADER_SIZE + offset
+        self.decode = decode
+
+    def __get__(self, message, cls):
+        if message is None: return self
+        start = self.offset + 1
+        value = message.frame[start:start + message.frame[self.offset]]
+        return self.decode(value) if self.decode else value
+
+class BytesField(object):
+    """Fixed-size raw byte field, or the rest of the payload if size is None."""
+    __slots__ = ('start', 'end')
+
+    def __init__(self, offset, size=None):
+        self.start = HEADER_SIZE + offset
+        self.end = self.start + size if size is not None else None
+
+    def __get__(self, message, cls):
+        if message is None: return self
+        return message.frame[self.start:self.end]
+
+class BleMessage(object):
     """Encapsulate low level BGAPI message containing header and payload."""
-    def __init__(self, header, payload):
-        assert(len(header) == 4)
-        self.header = header
-        self.payload = payload
+    __slots__ = ()
 
     def __str__(self):
         s = ''
@@ -114,66 +172,112 @@ class BleMessage:
         return h1[0] == h2[0] and h1[2] == h2[2] and h1[3] == h2[3]
 
 class BleCommand(BleMessage):
-    def __init__(self, header, payload=[]):
-        BleMessage.__init__(self, header, payload)
+    """Outgoing message built from header and payload byte lists."""
+    __slots__ = ('header', 'payload')
 
-class BleEvent(BleMessage):
     def __init__(self, header, payload=[]):
-        BleMessage.__init__(self, header, payload)
+        assert(len(header) == 4)
+        self.header = header
+        self.payload = payload
 
-class BleResponse(BleMessage):
-    def __init__(self, header, payload=[]):
-        BleMessage.__init__(self, header, payload)
+class BleFrame(BleMessage):
+    """Incoming message holding the raw frame (a bytearray) it was received
+    in. Subclasses set HEADER and describe their payload with Field,
+    ArrayField and BytesField. While metrics are enabled, received holds
+    the time the frame was read from the serial port.
+    """
+    __slots__ = ('frame', 'received')
+    HEADER = None
+
+    def __init__(self, frame=None):
+        self.frame = frame if frame is not None else bytearray(self.HEADER)
+        self.received = None
+
+    @property
+    def header(self):
+        return list(self.frame[0:HEADER_SIZE])
+
+    @property
+    def payload(self):
+        return self.frame[HEADER_SIZE:]
+
+class BleEvent(BleFrame):
+    __slots__ = ()
+
+class BleResponse(BleFrame):
+    __slots__ = ()
+
+class AttClientResponse(BleResponse):
+    """Local response to an attclient command, reporting whether the dongle
+    accepted it.
+    """
+    __slots__ = ()
+    connection = Field('B', 0)
+    result = Field('H', 1)
 
 class HelloResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x00, 0x01), payload)
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x00, 0x01)
 
 class GetInfoCommand(BleCommand):
+    __slots__ = ()
     def __init__(self):
         BleCommand.__init__(self, (0x00, 0x00, 0x00, 0x08))
 
 class HelloCommand(BleCommand):
+    __slots__ = ()
     def __init__(self):
         BleCommand.__init__(self, (0, 0, 0, 1))
 
 class SystemResetCommand(BleCommand):
+    __slots__ = ()
     def __init__(self):
         BleCommand.__init__(self, (0, 1, 0, 0), [0])
 
+@incoming
 class SystemBootEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x0C, 0x00, 0x00), payload)
+    __slots__ = ()
+    HEADER = (0x80, 0x0C, 0x00, 0x00)
 
+@incoming
 class SmBondingFailEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x03, 0x05, 0x01), payload)
+    __slots__ = ()
+    HEADER = (0x80, 0x03, 0x05, 0x01)
 
+@incoming
 class AttClientIndicated(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x03, 0x04, 0x00), payload)
+    __slots__ = ()
+    HEADER = (0x80, 0x03, 0x04, 0x00)
 
+@incoming
 class AttClientProcedureCompleted(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x00, 0x04, 0x01), payload)
-        if payload:
-            self.connection = payload[0]
-            self.result = Uint16().deserialize(payload[1:3])
-            self.chrHandle = Uint16().deserialize(payload[3:5])
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x04, 0x01)
+    connection = Field('B', 0)
+    result = Field('H', 1)
+    chrHandle = Field('H', 3)
 
 class ConnectionDisconnectCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection):
         BleCommand.__init__(self, (0x00, 0x01, 0x03, 0x00), [connection])
 
+@incoming
 class ConnectionDisconnectResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleMessage.__init__(self, (0x00, 0x03, 0x03, 0x00), payload)
+    __slots__ = ()
+    HEADER = (0x00, 0x03, 0x03, 0x00)
+    connection = Field('B', 0)
+    result = Field('H', 1)
 
+@incoming
 class ConnectionDisconnectedEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x00, 0x03, 0x04), payload)
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x03, 0x04)
+    connection = Field('B', 0)
+    reason = Field('H', 1)
 
 class ConnectDirectCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, address):
         addr_type = [1]
         conn_interval_min = Uint16(16).serialize() # Units of 1.25ms
@@ -188,82 +292,104 @@ class ConnectDirectCommand(BleCommand):
         payload.extend(latency)
         BleCommand.__init__(self, (0x00, 0x00, 0x06, 0x03), payload)
 
+@incoming
 class ConnectDirectResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleMessage.__init__(self, (0x00, 0x00, 0x06, 0x03), payload)
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x06, 0x03)
+    result = Field('H', 0)
+    connection = Field('B', 2)
+
+class GapEndProcedureCommand(BleCommand):
+    __slots__ = ()
+    def __init__(self):
+        BleCommand.__init__(self, (0x00, 0x00, 0x06, 0x04))
+
+@incoming
+class GapEndProcedureResponse(BleResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x02, 0x06, 0x04)
+    result = Field('H', 0)
 
+@incoming
 class ConnectionStatusEvent(BleEvent):
-    def __init__(self,  payload=[]):
-        BleEvent.__init__(self, (0x80, 0x00, 0x03, 0x00), payload)
-        if payload:
-            assert(len(payload) == 16)
-            self.connection = payload[0]
-            self.flags = payload[1]
-            self.address = payload[2:8]
-            self.bonding = payload[15]
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x03, 0x00)
+    connection = Field('B', 0)
+    flags = Field('B', 1)
+    address = BytesField(2, 6)
+    conn_interval = Field('H', 9) # Units of 1.25ms
+    bonding = Field('B', 15)
 
 class GetConnectionsCommand(BleCommand):
+    __slots__ = ()
     def __init__(self):
         BleCommand.__init__(self, (0x00, 0x00, 0x00, 0x06))
 
 class GetConnectionsResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleMessage.__init__(self, (0x00, 0x01, 0x00, 0x06), payload)
+    __slots__ = ()
+    HEADER = (0x00, 0x01, 0x00, 0x06)
 
 class GetConnectionsEvent(BleEvent):
-    def __init__(self, payload=[]):
-        if len(payload) >= 16:
-            self.connection    = self._payload[0]
-            self.flags         = self._payload[1]
-            self.bd_addr       = makeHexFromArray(self._payload[2:8])[::-1]
-            self.address_type  = self._payload[8]
-            self.conn_interval = makeHexFromArray(self._payload[9:11])[::-1]
-            self.timeout       = makeHexFromArray(self._payload[11:13])[::-1]
-            self.latency       = makeHexFromArray(self._payload[13:15])[::-1]
-            self.bonding       = self._payload[15]
-        BleMessage.__init__(self, (0x80, 0x10, 0x03, 0x00), payload)
+    __slots__ = ()
+    HEADER = (0x80, 0x10, 0x03, 0x00)
+    connection = Field('B', 0)
+    flags = Field('B', 1)
+    address_type = Field('B', 8)
+    conn_interval = Field('H', 9)
+    timeout = Field('H', 11)
+    latency = Field('H', 13)
+    bonding = Field('B', 15)
+
+    @property
+    def bd_addr(self):
+        return makeHexFromArray(self.payload[2:8])[::-1]
 
 class GetRssiCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection):
         BleCommand.__init__(self, (0x00, 0x01, 0x03, 0x01), [connection])
 
 class GetRssiResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleMessage.__init__(self, (0x00, 0x02, 0x03, 0x01), payload)
-        if payload:
-            self.connection = self._payload[0]
-            self.signalStr = self._payload[1]
+    __slots__ = ()
+    HEADER = (0x00, 0x02, 0x03, 0x01)
+    connection = Field('B', 0)
+    signalStr = Field('b', 1)
 
 class AttClientFindInformationCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, start, end):
         payload = [connection]
         payload.extend(Uint16(start).serialize())
         payload.extend(Uint16(end).serialize())
         BleCommand.__init__(self, [0x00, 0x00, 0x04, 0x03], payload)
 
-class AttClientFindInformationResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x03), payload)
+@incoming
+class AttClientFindInformationResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x03)
 
+@incoming
 class AttClientFindInformationFoundEvent(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x80, 0x00, 0x04, 0x04), payload)
-        if len(payload) >= 4:
-            self.connection = payload[0]
-            self.chrHandle = Uint16().deserialize(payload[1:3])
-            self.uuid = makeUuidFromArray(Uint8Array().deserialize(payload[3:]))
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x04, 0x04)
+    connection = Field('B', 0)
+    chrHandle = Field('H', 1)
+    uuid = ArrayField(3, makeUuidFromArray)
 
 class AttClientReadByHandleCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, handle):
         payload = [connection]
         payload.extend(Uint16(handle).serialize())
         BleCommand.__init__(self, (0x00, 0x00, 0x04, 0x04), payload)
 
-class AttClientReadByHandleResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x04), payload)
+@incoming
+class AttClientReadByHandleResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x04)
 
 class FindByTypeValueCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, start, end, uuid, value):
         payload = [connection]
         payload.extend(Uint16(start).serialize())
@@ -272,11 +398,13 @@ class FindByTypeValueCommand(BleCommand):
         payload.extend(Uint8Array(value).serialize())
         BleCommand.__init__(self, (0x00, 0x08, 0x04, 0x00), payload)
 
-class FindByTypeValueResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x00), payload)
+@incoming
+class FindByTypeValueResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x00)
 
 class ReadByGroupTypeCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, start, end, uuid):
         payload = [connection]
         payload.extend(Uint16(start).serialize())
@@ -284,45 +412,65 @@ class ReadByGroupTypeCommand(BleCommand):
         payload.extend(Uint8Array(uuid).serialize())
         BleCommand.__init__(self, (0x00, 0x00, 0x04, 0x01), payload)
 
-class ReadByGroupTypeResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x01), payload)
+@incoming
+class ReadByGroupTypeResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x01)
 
+@incoming
 class AttClientGroupFoundEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x00, 0x04, 0x02), payload)
-        if len(payload) > 5:
-            self.connection = payload[0]
-            self.start = Uint16().deserialize(payload[1:3])
-            self.end = Uint16().deserialize(payload[3:5])
-            self.uuid = makeUuidFromArray(Uint8Array().deserialize(payload[5:]))
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x04, 0x02)
+    connection = Field('B', 0)
+    start = Field('H', 1)
+    end = Field('H', 3)
+    uuid = ArrayField(5, makeUuidFromArray)
 
 class AttClientReadMultipleCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, handles):
         payload = [connection]
         for handle in handles:
-            self._payload.extend(Uint16(handle).serialize())
+            payload.extend(Uint16(handle).serialize())
         BleCommand.__init__(self, (0x00, 0x02, 0x04, 0x0B), payload)
 
 class AttClientReadMultipleResponse(BleResponse):
-    def __init__(self, payload=[]):
-        if payload:
-            self.connection = payload[0]
-            self.attHandles = payload[1:]
-        BleResponse.__init__(self, (0x00, 0x03, 0x04, 0x0B), payload)
+    __slots__ = ()
+    HEADER = (0x00, 0x03, 0x04, 0x0B)
+    connection = Field('B', 0)
+    attHandles = BytesField(1)
 
 class AttClientAttributeWriteCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, handle, data):
         payload = [connection]
         payload.extend(Uint16(handle).serialize())
         payload.extend(Uint8Array(data).serialize())
         BleCommand.__init__(self, (0x00, 0x00, 0x04, 0x05), payload)
 
-class AttClientAttributeWriteResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x05), payload)
+@incoming
+class AttClientAttributeWriteResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x05)
+
+class AttClientWriteCommand(BleCommand):
+    """Write without response: the value goes out in the next connection
+    event and no procedure completed event follows.
+    """
+    __slots__ = ()
+    def __init__(self, connection, handle, data):
+        payload = [connection]
+        payload.extend(Uint16(handle).serialize())
+        payload.extend(Uint8Array(data).serialize())
+        BleCommand.__init__(self, (0x00, 0x00, 0x04, 0x06), payload)
+
+@incoming
+class AttClientWriteCommandResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x06)
 
 class AttClientAttributePrepareWriteCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection, handle, offset, data):
         payload = [connection]
         payload.extend(Uint16(handle).serialize())
@@ -330,77 +478,56 @@ class AttClientAttributePrepareWriteCommand(BleCommand):
         payload.extend(Uint8Array(data).serialize())
         BleCommand.__init__(self, (0x00, 0x00, 0x04 , 0x09), payload)
 
-class AttClientAttributePrepareWriteResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x09), payload)
+@incoming
+class AttClientAttributePrepareWriteResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x09)
 
 class AttClientExecuteWriteCommand(BleCommand):
+    __slots__ = ()
     def __init__(self, connection):
         BleCommand.__init__(self, (0x00, 0x02, 0x04, 0x0A), [connection, 1])
 
-class AttClientExecuteWriteCommandResponse(BleResponse):
-    def __init__(self, payload=[]):
-        BleResponse.__init__(self, (0x00, 0x00, 0x04, 0x0A), payload)
-        if payload:
-            self.connection = payload[0]
-            self.result = payload[0] + payload[1] * 256
+@incoming
+class AttClientExecuteWriteCommandResponse(AttClientResponse):
+    __slots__ = ()
+    HEADER = (0x00, 0x00, 0x04, 0x0A)
 
+@incoming
 class AttClientAttributeValueEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x00, 0x04, 0x05), payload)
-        if payload:
-            self.connection = payload[0]
-            self.attHandle = Uint16().deserialize(payload[1:3])
-            self.type = payload[3]
-            self.data = payload[5:]
+    __slots__ = ()
+    HEADER = (0x80, 0x00, 0x04, 0x05)
+    connection = Field('B', 0)
+    attHandle = Field('H', 1)
+    type = Field('B', 3)
+    data = ArrayField(4)
 
 class AttClientReadMultipleResponseEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x02, 0x04, 0x06), [])
-        if payload:
-            self.attValue = self.payload[5:]
-            self.attHandle = Uint16().deserialize(self.payload[1:3])
+    __slots__ = ()
+    HEADER = (0x80, 0x02, 0x04, 0x06)
+    attHandle = Field('H', 1)
+    attValue = BytesField(5)
 
+@incoming
 class ProtocolErrorEvent(BleEvent):
-    def __init__(self, payload=[]):
-        BleEvent.__init__(self, (0x80, 0x02, 0x00, 0x06), payload)
-        if payload:
-            self.reason = Uint16().deserialize(payload[0:2])
+    __slots__ = ()
+    HEADER = (0x80, 0x02, 0x00, 0x06)
+    reason = Field('H', 0)
 
-def makeBleMessage(header, payload):
+def makeBleMessage(frame):
     """Factory method for identifying incoming BLE messages and creating the
-    correct message subclass instance.
+    correct message subclass instance from the raw frame.
     """
-
-    # All the supported messages are listed here. Keep ABC-sorted for neatness.
-    lookup = {
-        AttClientAttributePrepareWriteResponse().header : AttClientAttributePrepareWriteResponse,
-        AttClientAttributeValueEvent().header : AttClientAttributeValueEvent,
-        AttClientAttributeWriteResponse().header : AttClientAttributeWriteResponse,
-        AttClientExecuteWriteCommandResponse().header : AttClientExecuteWriteCommandResponse,
-        AttClientFindInformationFoundEvent().header : AttClientFindInformationFoundEvent,
-        AttClientFindInformationResponse().header : AttClientFindInformationResponse,
-        AttClientGroupFoundEvent().header : AttClientGroupFoundEvent,
-        AttClientProcedureCompleted().header : AttClientProcedureCompleted,
-        AttClientReadByHandleResponse().header : AttClientReadByHandleResponse,
-        ConnectDirectResponse().header : ConnectDirectResponse,
-        ConnectionDisconnectedEvent().header : ConnectionDisconnectedEvent,
-        ConnectionStatusEvent().header : ConnectionStatusEvent,
-        FindByTypeValueResponse().header : FindByTypeValueResponse,
-        ReadByGroupTypeResponse().header : ReadByGroupTypeResponse,
-    }
-    # Clear payload length to allow identification by header
-    cleanHeader = tuple([header[0], 0, header[2], header[3]])
-    ctor = lookup.get(cleanHeader)
+    ctor = messageIndex.get(messageKey(frame))
     if ctor:
-        return ctor(payload)
+        return ctor(frame)
     else:
-        msg = BleMessage(header, payload)
+        msg = BleFrame(frame)
         print 'Unknown message %s' % str(msg)
         return msg
 
 class Bled112Com(threading.Thread):
-    HEADER_SIZE = 4
+    HEADER_SIZE = HEADER_SIZE
     PAYLOAD_LENGTH_OFFSET = 1
     WAIT_TIMEOUT = 2
 
@@ -410,18 +537,19 @@ class Bled112Com(threading.Thread):
             raise RuntimeError('BLED112 serial port not found')
         return ports[0][0]
 
-    def __init__(self, serialPort=None):
-        comName = serialPort or self.findPort()
-        self.serialDevice = serial.Serial(port=comName,
-                                          baudrate=115200,
-                                          timeout=0.001,
-                                          stopbits=serial.STOPBITS_TWO,
-                                          rtscts=True)
+    def __init__(self, serialPort=None, serialDevice=None):
+        self.serialDevice = serialDevice or serial.Serial(port=serialPort or self.findPort(),
+                                                          baudrate=115200,
+                                                          timeout=None,
+                                                          stopbits=serial.STOPBITS_TWO,
+                                                          rtscts=True)
         threading.Thread.__init__(self)
-        self.incoming = []
+        self.incoming = bytearray()
         self.isTerminated = False
         self.listener = None
         self.terminate = False
+        # The dongle runs one connect procedure at a time
+        self.connectLock = threading.Lock()
         return
 
     @staticmethod
@@ -445,20 +573,40 @@ class Bled112Com(threading.Thread):
         self.serialDevice.flush()
         return
 
-    def readMessage(self):
-        self.incoming.extend(self.serialDevice.read())
-        if len(self.incoming) < self.HEADER_SIZE: return
-        payloadLength = ord(self.incoming[self.PAYLOAD_LENGTH_OFFSET])
-        if self.HEADER_SIZE + payloadLength > len(self.incoming): return
-        header = map(ord, self.incoming[0:self.HEADER_SIZE])
-        del self.incoming[0:self.HEADER_SIZE]
-        payload = []
-        if payloadLength:
-            payload = map(ord, self.incoming[0:payloadLength])
-            del self.incoming[0:payloadLength]
-        msg = makeBleMessage(header, payload)
-        if DEBUG: self.echoMessage(msg, 'RX:')
-        return msg
+    def readMessages(self):
+        """Block until the serial device has data, read whatever it holds in
+        one call and return all complete messages found in the receive
+        buffer. Returns early, possibly empty, when close() cancels the read.
+        """
+        device = self.serialDevice
+        self.incoming.extend(device.read(device.in_waiting or 1))
+        if not metrics.enabled:
+            return self.parseMessages()
+
+        received = time.time()
+        messages = self.parseMessages()
+        for message in messages:
+            message.received = received
+        return messages
+
+    def parseMessages(self):
+        """Split all complete frames off the receive buffer. A trailing
+        partial frame stays buffered until the rest of it arrives.
+        """
+        buf = self.incoming
+        size = len(buf)
+        offset = 0
+        messages = []
+        while size - offset >= self.HEADER_SIZE:
+            end = offset + self.HEADER_SIZE + buf[offset + self.PAYLOAD_LENGTH_OFFSET]
+            if end > size: break
+            msg = makeBleMessage(buf[offset:end])
+            if DEBUG: self.echoMessage(msg, 'RX:')
+            messages.append(msg)
+            offset = end
+        if offset:
+            del buf[:offset]
+        return messages
 
     def reset(self):
         self.send(SystemResetCommand())
@@ -467,9 +615,9 @@ class Bled112Com(threading.Thread):
     def run(self):
         logging.info('BLED112 thread started')
         while True:
-            m = self.readMessage()
-            if m and self.listener:
-                self.listener.onMessage(m)
+            for m in self.readMessages():
+                if self.listener:
+                    self.listener.onMessage(m)
             if self.terminate:
                 self.serialDevice.close()
                 logging.info('BLED112 thread stopped')
@@ -478,3 +626,4 @@ class Bled112Com(threading.Thread):
 
     def close(self):
         self.terminate = True
+        self.serialDevice.cancel_read()
@@ -2,14 +2,22 @@
 
 from __future__ import division
 
+import fcntl
+import json
 import logging
 import math
+import os
+import select
 import signal
 import sys
+import threading
 import time
 from threading import Timer
 
 import led_configs
+import metrics
+from bled112 import Bled112Com
+from gatt import BleMultiplexer, HandleCache
 from nuimo import Nuimo, NuimoDelegate
 from sonos import SonosAPI
 
@@ -19,23 +27,37 @@ nuimo_sonos_controller = None
 
 class NuimoSonosController(NuimoDelegate):
 
-    def __init__(self, bled_com, nuimo_mac):
+    def __init__(self, bled_com, nuimo_mac, nuimo=None, sonos=None, handle_cache=None):
         NuimoDelegate.__init__(self)
-        self.nuimo = Nuimo(bled_com, nuimo_mac, self)
-        self.sonos = SonosAPI()
+        self.nuimo = nuimo or Nuimo(bled_com, nuimo_mac, self, handle_cache)
+        self.sonos = sonos or SonosAPI()
+        self.sonos.on_state = self._on_sonos_state
+        self.predicted_state = None
+        # Submitted commands not yet done; state events are not trusted meanwhile
+        self.commands_pending = 0
+        self.commands_lock = threading.Lock()
+        self.led_latency = None
+        self.speaker_latency = None
         self.default_led_timeout = 3
         self.max_volume = 42 # should be dividable by 7
         self.volume_bucket_size = int(self.max_volume / 7)
         self.last_vol_matrix = None
         self.vol_reset_timer = None
         self.stop_pending = False
+        self.volume_aggregator = VolumeAggregator(self.sonos, self._show_volume)
+        self.volume_aggregator.start()
 
     def start(self):
-        self.nuimo.connect()
+        # Not waiting for the Nuimo, which may be out of range, keeps the
+        # process responsive to signals meanwhile
+        self.nuimo.connect(wait=False)
 
-        while not self.stop_pending:
-            time.sleep(0.1)
+        wait_for_stop(self)
 
+        self.shutdown()
+
+    def shutdown(self):
+        self.volume_aggregator.terminate()
         self.sonos.disconnect()
         self.nuimo.disconnect()
         self.nuimo.terminate()
@@ -44,20 +66,17 @@ class NuimoSonosController(NuimoDelegate):
         self.stop_pending = True
 
     def on_button(self):
+        started = time.time()
         if self.sonos.is_playing():
-            self.sonos.pause()
-            self.nuimo.display_led_matrix(led_configs.pause, self.default_led_timeout)
+            self._run_command(started, self.sonos.pause, led_configs.pause, SonosAPI.STATE_PAUSED)
         else:
-            self.sonos.play()
-            self.nuimo.display_led_matrix(led_configs.play, self.default_led_timeout)
+            self._run_command(started, self.sonos.play, led_configs.play, SonosAPI.STATE_PLAYING)
 
     def on_swipe_right(self):
-        self.sonos.next()
-        self.nuimo.display_led_matrix(led_configs.next, self.default_led_timeout)
+        self._run_command(time.time(), self.sonos.next, led_configs.next)
 
     def on_swipe_left(self):
-        self.sonos.prev()
-        self.nuimo.display_led_matrix(led_configs.previous, self.default_led_timeout)
+        self._run_command(time.time(), self.sonos.prev, led_configs.previous)
 
     def on_fly_right(self):
         self.on_swipe_right()
@@ -66,21 +85,58 @@ class NuimoSonosController(NuimoDelegate):
         self.on_swipe_left()
 
     def on_wheel_right(self, value):
-        self.sonos.vol_up(self._calculate_volume_delta(value))
-        self._show_volume()
+        self.volume_aggregator.add(self._calculate_volume_delta(value))
 
     def on_wheel_left(self, value):
-        self.sonos.vol_down(self._calculate_volume_delta(value))
-        self._show_volume()
+        self.volume_aggregator.add(-self._calculate_volume_delta(value))
 
     def on_connect(self):
         self.nuimo.display_led_matrix(led_configs.default, self.default_led_timeout)
 
-    def _calculate_volume_delta(self, value):
+    def _run_command(self, started, command, matrix, state=None):
+        """Draws the expected outcome right away and sends the command in the
+        background. The LED is corrected if the command fails or, for
+        transport state, if the speaker reports a different state once no
+        command is outstanding.
+        """
+        previous = None
+        if state:
+            previous = self.sonos.predict_state(state)
+            self.predicted_state = state
+        self.nuimo.display_led_matrix(matrix, self.default_led_timeout)
+        self.led_latency = time.time() - started
+
+        def on_done(future):
+            with self.commands_lock:
+                self.commands_pending -= 1
+            self.speaker_latency = time.time() - started
+            if future.error:
+                logging.warning("Sonos command failed: {}".format(future.error))
+                if state and self.sonos.state == state:
+                    self.sonos.predict_state(previous)
+                self.predicted_state = None
+                self.nuimo.display_led_matrix(led_configs.error, self.default_led_timeout)
+
+        with self.commands_lock:
+            self.commands_pending += 1
+        self.sonos.submit(command).add_callback(on_done)
+
+    def _on_sonos_state(self, state):
+        with self.commands_lock:
+            # May predate a command still in flight; keep the prediction
+            # for the events that follow it
+            if self.commands_pending:
+                return
+            predicted, self.predicted_state = self.predicted_state, None
+        if predicted and (state == SonosAPI.STATE_PLAYING) != (predicted == SonosAPI.STATE_PLAYING):
+            matrix = led_configs.play if state == SonosAPI.STATE_PLAYING else led_configs.pause
+            self.nuimo.display_led_matrix(matrix, self.default_led_timeout)
+
+    @staticmethod
+    def _calculate_volume_delta(value):
         return min(value / 20 + 1, 5)
 
-    def _show_volume(self):
-        volume = self.sonos.get_volume()
+    def _show_volume(self, volume):
         if volume is None: volume = 0
 
         bucket = min(int(math.ceil(volume / self.volume_bucket_size)), 7)
@@ -98,6 +154,165 @@ class NuimoSonosController(NuimoDelegate):
         self.vol_reset_timer = None
 
 
+class VolumeAggregator(threading.Thread):
+    """Collects wheel volume deltas and sends one absolute volume to Sonos
+    per window. A window starts with the first delta after the previous
+    call returned, so deltas arriving during a slow call go into the next
+    one.
+    """
+
+    def __init__(self, sonos, on_volume, window=0.1):
+        super(VolumeAggregator, self).__init__()
+        self.daemon = True
+        self.sonos = sonos
+        self.on_volume = on_volume
+        self.window = window
+        self.condition = threading.Condition()
+        self.delta = 0
+        self.pending = False
+        self.stop = False
+        self.requests = 0
+
+    def add(self, delta):
+        with self.condition:
+            self.delta += delta
+            self.pending = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stop:
+                    self.condition.wait()
+                if self.stop:
+                    break
+
+            time.sleep(self.window)
+
+            with self.condition:
+                delta = self.delta
+                self.delta = 0
+                self.pending = False
+
+            try:
+                self._apply(delta)
+            except Exception as e:
+                logging.exception(e)
+
+    def _apply(self, delta):
+        current = self.sonos.get_volume() or 0
+        target = current + delta
+        volume = max(0, min(100, int(round(target))))
+        if 0 < target < 100:
+            # Carry the fraction not applied into the next window, so that
+            # the same wheel input moves the volume as far at any speed
+            with self.condition:
+                self.delta += target - volume
+        if volume != current:
+            self.sonos.set_volume(volume)
+            self.requests += 1
+        self.on_volume(volume)
+
+    def terminate(self):
+        with self.condition:
+            self.stop = True
+            self.condition.notify()
+
+
+class MultiRoomController:
+    """Runs one NuimoSonosController per room of a config such as
+
+        {"adapters": ["/dev/ttyACM0"],
+         "rooms": [{"nuimo": "A1:B2:C3:D4:E5:F6", "zone": "Living Room"},
+                   {"nuimo": "A1:B2:C3:D4:E5:F7", "zone": "Kitchen", "adapter": "/dev/ttyACM0"}]}
+
+    All rooms share one SonosAPI, so one discovery and one set of event
+    subscriptions, and one HandleCache, so one writer of its file. Each
+    BLED112 is shared through a BleMultiplexer. Rooms without an adapter
+    are spread over the listed ones.
+    """
+
+    def __init__(self, config, sonos=None, handle_cache=None):
+        self.sonos = sonos or SonosAPI()
+        self.handle_cache = handle_cache or HandleCache()
+        self.adapters = {}
+        self.rooms = []
+        self.stop_pending = False
+
+        ports = config.get('adapters') or [None]
+        for index, room in enumerate(config['rooms']):
+            port = room.get('adapter') or ports[index % len(ports)]
+            if port not in self.adapters:
+                self.adapters[port] = BleMultiplexer(self._open_adapter(port))
+            controller = NuimoSonosController(self.adapters[port], room['nuimo'],
+                                              sonos=self.sonos.zone(room['zone']),
+                                              handle_cache=self.handle_cache)
+            self.rooms.append(controller)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _open_adapter(self, port):
+        return Bled112Com(port)
+
+    def connect(self, wait=True):
+        """Starts the adapters and the supervisors, which connect all Nuimos
+        at once. With wait, returns when every one of them is ready.
+        """
+        for multiplexer in self.adapters.values():
+            multiplexer.start()
+        for room in self.rooms:
+            room.nuimo.connect(wait=False)
+        if wait:
+            for room in self.rooms:
+                room.nuimo.supervisor.wait_ready()
+
+    def start(self):
+        # A room out of range, or beyond the links its adapter supports,
+        # must not keep the others from shutting down on a signal
+        self.connect(wait=False)
+
+        wait_for_stop(self)
+
+        self.shutdown()
+
+    def stop(self):
+        self.stop_pending = True
+
+    def shutdown(self):
+        for room in self.rooms:
+            room.shutdown()
+        self.sonos.disconnect()
+        for multiplexer in self.adapters.values():
+            multiplexer.close()
+
+
+def wait_for_stop(controller):
+    """Sleeps until a signal handler sets controller.stop_pending. Signals
+    also write a byte to a pipe that is selected on, so one arriving right
+    before the select still ends the wait.
+    """
+    reader, writer = os.pipe()
+    for fd in (reader, writer):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(writer)
+    try:
+        while not controller.stop_pending:
+            try:
+                readable, _, _ = select.select([reader], [], [])
+            except select.error:
+                # Interrupted by the signal; its handler has run
+                continue
+            if readable:
+                os.read(reader, 64)
+    finally:
+        signal.set_wakeup_fd(-1)
+        os.close(reader)
+        os.close(writer)
+
+
 def signal_term_handler(signal, frame):
     logging.info('Received SIGTERM signal!')
     nuimo_sonos_controller.stop()
@@ -115,11 +330,16 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, signal_term_handler)
     signal.signal(signal.SIGINT, signal_int_handler)
 
-    if len(sys.argv) != 3:
-        raise RuntimeError('Invalid number of arguments')
+    arguments = sys.argv[1:]
+    if arguments[:1] == ['--metrics']:
+        metrics.serve(int(arguments[1]))
+        arguments = arguments[2:]
 
-    com = sys.argv[1]
-    mac = sys.argv[2]
+    if len(arguments) == 1:
+        nuimo_sonos_controller = MultiRoomController.from_file(arguments[0])
+    elif len(arguments) == 2:
+        nuimo_sonos_controller = NuimoSonosController(arguments[0], arguments[1])
+    else:
+        raise RuntimeError('Invalid number of arguments')
 
-    nuimo_sonos_controller = NuimoSonosController(com, mac)
     nuimo_sonos_controller.start()
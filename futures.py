@@ -0,0 +1,171 @@
+"""Futures shared by the BLED112 and Sonos code, and the one thread serving
+their timeouts. On Python 2 a timed wait on a Lock, Condition or Event
+polls, and a threading.Timer starts a thread per timeout. The deadline
+thread instead sleeps in select() until the earliest deadline is due or
+an earlier one is added.
+"""
+
+import fcntl
+import heapq
+import logging
+import os
+import select
+import threading
+import time
+
+
+class Deadlines(threading.Thread):
+    """Calls functions once their deadline has passed, all from one daemon
+    thread started on first use. Cancelled entries are only marked and
+    dropped when they reach the front.
+    """
+
+    def __init__(self):
+        super(Deadlines, self).__init__()
+        self.daemon = True
+        self.entries = []
+        self.sequence = 0
+        self.running = False
+        self.lock = threading.Lock()
+        self.reader, self.writer = os.pipe()
+        for fd in (self.reader, self.writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def schedule(self, delay, function, *args):
+        """Calls function(*args) in delay seconds. Returns the entry to pass
+        to cancel().
+        """
+        with self.lock:
+            self.sequence += 1
+            entry = [time.time() + delay, self.sequence, function, args]
+            heapq.heappush(self.entries, entry)
+            earliest = self.entries[0] is entry
+            if not self.running:
+                self.running = True
+                self.start()
+        if earliest:
+            self.wake()
+        return entry
+
+    def cancel(self, entry):
+        with self.lock:
+            entry[2] = None
+
+    def wake(self):
+        try:
+            os.write(self.writer, b'.')
+        except OSError:
+            # The pipe is full, so the thread wakes anyway
+            pass
+
+    def run(self):
+        while True:
+            due = []
+            with self.lock:
+                now = time.time()
+                while self.entries and (self.entries[0][2] is None or self.entries[0][0] <= now):
+                    entry = heapq.heappop(self.entries)
+                    if entry[2] is not None:
+                        due.append((entry[2], entry[3]))
+                timeout = self.entries[0][0] - now if self.entries else None
+            if due:
+                for function, args in due:
+                    try:
+                        function(*args)
+                    except Exception as e:
+                        logging.exception(e)
+                continue
+            try:
+                select.select([self.reader], [], [], timeout)
+                os.read(self.reader, 4096)
+            except (select.error, OSError):
+                pass
+
+
+deadlines = Deadlines()
+
+
+class Future(object):
+    """Outcome of an operation finished on another thread: a value or an
+    error.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.done = threading.Lock()
+        self.done.acquire()
+
+    def is_done(self):
+        return self.callbacks is None
+
+    def resolve(self, value=None, error=None):
+        """Finish with a value or an error, then run the callbacks. Returns
+        False if the future was already done.
+        """
+        with self.lock:
+            if self.callbacks is None:
+                return False
+            callbacks, self.callbacks = self.callbacks, None
+            self.value = value
+            self.error = error
+        self.done.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.exception(e)
+        return True
+
+    def add_callback(self, callback):
+        """Call callback(future) once done, right away if it already is."""
+        with self.lock:
+            if self.callbacks is not None:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """Returns True once done, or False if timeout seconds passed first."""
+        if timeout is None:
+            self.done.acquire()
+            self.done.release()
+            return True
+        if self.is_done():
+            return True
+
+        woken = threading.Lock()
+        woken.acquire()
+        fired = []
+
+        def wake(*args):
+            with self.lock:
+                if fired:
+                    return
+                fired.append(True)
+            woken.release()
+
+        self.add_callback(wake)
+        entry = deadlines.schedule(timeout, wake)
+        woken.acquire()
+        deadlines.cancel(entry)
+        return self.is_done()
+
+
+class CountDown(Future):
+    """Future done once finish() was called count times."""
+
+    def __init__(self, count):
+        Future.__init__(self)
+        self.remaining = count
+        if count <= 0:
+            self.resolve()
+
+    def finish(self):
+        with self.lock:
+            self.remaining -= 1
+            remaining = self.remaining
+        if remaining == 0:
+            self.resolve()
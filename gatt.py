@@ -1,4 +1,10 @@
 from bled112 import *
+from futures import Future, deadlines
+import jsonfile
+
+import collections
+import json
+import os
 
 DEBUG = True
 INFO = True
@@ -21,11 +27,186 @@ class BleProcedureFailure(BleException): pass
 class BleLocalTimeout(BleException): pass
 class BleRemoteTimeout(BleException): pass
 class BleValueError(BleException): pass
+class BleNotConnected(BleException): pass
+
+class BleWaiter(Future):
+    """Pending expectation of an incoming message of a given class, optionally
+    restricted to a connection and an attribute handle. Its value is the
+    message.
+    """
+    def __init__(self, messageClass, connection=None, handle=None):
+        Future.__init__(self)
+        self.messageClass = messageClass
+        self.connection = connection
+        self.handle = handle
+
+    def matches(self, message):
+        if self.connection is not None and message.connection != self.connection:
+            return False
+        if self.handle is not None and messageHandle(message) != self.handle:
+            return False
+        return True
+
+class GattRequest(Future):
+    """GATT operation queued on a GattScheduler. Done with the message that
+    completed it, or with a BleException.
+    command -- command to send
+    responseClass -- local response the dongle answers the command with
+    completionClass -- event completing the operation, None if the response
+                       alone does
+    handle -- attribute handle the completion event must refer to
+    """
+    def __init__(self, command, responseClass, completionClass=AttClientProcedureCompleted, handle=None):
+        Future.__init__(self)
+        self.command = command
+        self.responseClass = responseClass
+        self.completionClass = completionClass
+        self.handle = handle
+        # Discovery results to wait for, resolving `satisfied` once all found
+        self.wanted = None
+        self.satisfied = None
+        self.response = None
+        self.completion = None
+        # Deadline entry of the running local or remote timeout
+        self.timer = None
+        # Filled with the results found during a discovery procedure
+        self.found = {}
+
+    def result(self):
+        """Wait for the operation and return its completing message, or raise
+        the BleException it failed with.
+        """
+        self.wait()
+        if self.error: raise self.error
+        return self.value
+
+class GattScheduler:
+    """Queue of GATT operations on one connection, keeping at most maxInFlight
+    of them outstanding. Operations completed by a separate event (GATT
+    procedures) run one at a time, as the dongle accepts only one procedure
+    per connection. Responses and completion events are matched by class and
+    connection, which identifies the request since the dongle answers in
+    order.
+    """
+    def __init__(self, manager, maxInFlight=4):
+        self.manager = manager
+        self.maxInFlight = maxInFlight
+        self.queue = collections.deque()
+        self.inFlight = []
+        self.lock = threading.RLock()
+        # Number of operations sent, i.e. round trips to the device
+        self.issued = 0
+
+    def submit(self, request):
+        with self.lock:
+            self.queue.append(request)
+        self.pump()
+        return request
+
+    def pump(self):
+        failed = []
+        with self.lock:
+            while self.queue and len(self.inFlight) < self.maxInFlight:
+                request = self.queue[0]
+                if request.completionClass and self.runningProcedure(): break
+                self.queue.popleft()
+                error = self.issue(request)
+                if error: failed.append((request, error))
+        for request, error in failed:
+            request.resolve(error=error)
+
+    def runningProcedure(self):
+        """The in-flight request waiting for its completion event, if any."""
+        with self.lock:
+            for request in self.inFlight:
+                if request.completionClass: return request
+        return None
+
+    def issue(self, request):
+        """Send a request. If that fails, it is taken out of flight again
+        and the error returned, to resolve it with outside the lock.
+        """
+        ble = self.manager
+        connection = ble.connection.id
+        request.response = ble.expect(request.responseClass, connection)
+        request.response.add_callback(lambda waiter: self.onResponse(request, waiter.value))
+        if request.completionClass:
+            request.completion = ble.expect(request.completionClass, connection, request.handle)
+            request.completion.add_callback(lambda waiter: self.onCompletion(request, waiter.value))
+        self.inFlight.append(request)
+        self.issued += 1
+        self.startTimer(request, ble.localTimeout, BleLocalTimeout)
+        try:
+            ble.com.send(request.command)
+        except Exception as e:
+            # E.g. a serial error, or the link dropped after the request was built
+            logging.warning('Sending %s failed: %s' % (request.command.__class__.__name__, e))
+            self.inFlight.remove(request)
+            deadlines.cancel(request.timer)
+            ble.discard(*[w for w in (request.response, request.completion) if w])
+            return BleException('Sending failed: %s' % e)
+        return None
+
+    def startTimer(self, request, timeout, errorClass):
+        request.timer = deadlines.schedule(timeout, self.expire, request, errorClass)
+
+    def expire(self, request, errorClass):
+        with self.lock:
+            if request not in self.inFlight: return
+        self.manager.timeouts += 1
+        self.finish(request, error=errorClass())
+
+    def onResponse(self, request, message):
+        if message is None: return
+        if message.result:
+            self.finish(request, error=BleProcedureFailure('Command rejected with result 0x%04X' % message.result))
+        elif request.completionClass is None:
+            self.finish(request, message)
+        else:
+            with self.lock:
+                if request not in self.inFlight: return
+                deadlines.cancel(request.timer)
+                self.startTimer(request, self.manager.remoteTimeout, BleRemoteTimeout)
+
+    def onCompletion(self, request, message):
+        if message is None: return
+        result = getattr(message, 'result', 0)
+        if result:
+            self.finish(request, error=BleProcedureFailure('Procedure failed with result 0x%04X' % result))
+        else:
+            self.finish(request, message)
+
+    def finish(self, request, message=None, error=None):
+        with self.lock:
+            if request not in self.inFlight: return
+            self.inFlight.remove(request)
+            deadlines.cancel(request.timer)
+        self.manager.discard(*[w for w in (request.response, request.completion) if w])
+        request.resolve(message, error)
+        self.pump()
+
+    def cancelAll(self, errorClass=BleRemoteTimeout):
+        """Fail all queued and in-flight requests, e.g. after a disconnect."""
+        with self.lock:
+            queued = list(self.queue)
+            self.queue.clear()
+            inFlight = list(self.inFlight)
+        for request in queued:
+            request.resolve(error=errorClass())
+        for request in inFlight:
+            self.finish(request, error=errorClass())
+
+def messageHandle(message):
+    """Attribute handle an incoming message refers to, if any."""
+    handle = getattr(message, 'chrHandle', None)
+    return handle if handle is not None else getattr(message, 'attHandle', None)
 
 class BleConnection:
     def __init__(self, mac=None):
         self.id = None
         self.address = mac
+        # Connection interval in seconds, as negotiated on connect
+        self.interval = 0.04
 
 class AttributeGroup:
     """Encapsulate a group of GATT attribute/descriptor handles.
@@ -38,6 +219,132 @@ class AttributeGroup:
         self.start = start
         self.end = end
 
+class HandleCache:
+    """Characteristic handles per device address, persisted as JSON so that
+    reconnects can skip service discovery. Entries carry a signature of what
+    was discovered and are ignored when it no longer matches.
+    """
+    def __init__(self, path='~/.nuimo_handles.json'):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, address, signature):
+        entry = self.entries.get(address.upper())
+        if entry and entry.get('signature') == signature:
+            return entry['handles']
+        return None
+
+    def put(self, address, signature, handles):
+        with self.lock:
+            self.entries[address.upper()] = {'signature': signature, 'handles': handles}
+        self.save()
+
+    def invalidate(self, address):
+        with self.lock:
+            removed = self.entries.pop(address.upper(), None)
+        if removed is not None:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            jsonfile.save(self.path, self.entries, 'handle cache')
+
+class BleChannel:
+    """One device's share of a BleMultiplexer. Its BleManager uses it in
+    place of the Bled112Com.
+    """
+    def __init__(self, multiplexer, address):
+        self.multiplexer = multiplexer
+        self.address = [int(i, 16) for i in reversed(address.split(':'))]
+        self.connectLock = multiplexer.connectLock
+        self.outgoing = collections.deque()
+        self.listener = None
+
+    def send(self, message):
+        self.multiplexer.send(self, message)
+
+class BleMultiplexer:
+    """Serves several devices over one BLED112. Incoming messages go to the
+    channel owning their connection id; a connection status is matched by
+    address and a connect response goes to the channel connecting, anything
+    else without a connection reaches all channels. Commands are written
+    round robin, one per channel with pending commands, by whichever
+    sender finds the serial port idle.
+    """
+    def __init__(self, com):
+        self.com = com
+        self.connectLock = com.connectLock
+        self.channels = []
+        self.connections = {}
+        self.connecting = None
+        self.ready = collections.deque()
+        self.writing = False
+        self.lock = threading.Lock()
+        com.listener = self
+
+    def start(self):
+        self.com.start()
+
+    def close(self):
+        self.com.reset()
+        self.com.close()
+
+    def channel(self, address):
+        channel = BleChannel(self, address)
+        with self.lock:
+            self.channels.append(channel)
+        return channel
+
+    def send(self, channel, message):
+        with self.lock:
+            if isinstance(message, ConnectDirectCommand):
+                self.connecting = channel
+            if not channel.outgoing:
+                self.ready.append(channel)
+            channel.outgoing.append(message)
+            if self.writing: return
+            self.writing = True
+        try:
+            while True:
+                with self.lock:
+                    if not self.ready:
+                        self.writing = False
+                        return
+                    channel = self.ready.popleft()
+                    message = channel.outgoing.popleft()
+                    if channel.outgoing:
+                        self.ready.append(channel)
+                self.com.send(message)
+        except:
+            with self.lock:
+                self.writing = False
+            raise
+
+    # Called by BLED112 thread
+    def onMessage(self, message):
+        with self.lock:
+            if isinstance(message, ConnectionStatusEvent):
+                address = list(bytearray(message.address))
+                channel = next((c for c in self.channels if c.address == address), None)
+                if channel:
+                    self.connections[message.connection] = channel
+            elif isinstance(message, ConnectDirectResponse):
+                channel = self.connecting
+            else:
+                channel = self.connections.get(getattr(message, 'connection', None))
+            if isinstance(message, ConnectionDisconnectedEvent):
+                self.connections.pop(message.connection, None)
+                # A link no channel owns; it must not drop the others
+                if not channel: return
+            targets = [channel] if channel else list(self.channels)
+        for target in targets:
+            if target.listener: target.listener.onMessage(message)
+
 class BleManager:
     def __init__(self, com, address, delegate = None):
         self.reactions = {
@@ -51,56 +358,124 @@ class BleManager:
         self.connection = BleConnection(mac)
         self.com = com
         self.delegate = delegate
-        self.expectedMessage = None
+        self.waiters = {}
+        self.waitersLock = threading.Lock()
+        self.scheduler = GattScheduler(self)
         com.listener = self
         self.localTimeout = 5
         self.remoteTimeout = 10
+        # Requests and expected messages that timed out
+        self.timeouts = 0
 
     # Called by BLED112 thread
     def onMessage(self, message):
-        if self.expectedMessage and message.__class__ == self.expectedMessage.__class__:
-            self.actualMessage = message
-            self.expectedMessage = None
+        waiter = self.takeWaiter(message)
+        if waiter:
+            waiter.resolve(message)
         else:
             reaction = self.reactions.get(message.__class__)
             if reaction: reaction(message)
 
+    def takeWaiter(self, message):
+        with self.waitersLock:
+            waiters = self.waiters.get(message.__class__)
+            if waiters:
+                for waiter in waiters:
+                    if waiter.matches(message):
+                        waiters.remove(waiter)
+                        return waiter
+        return None
+
     def onConnectionDisconnectedEvent(self, message):
-        logging.info('Disconnected')
+        logging.info('Disconnected, reason 0x%04X' % message.reason)
         self.connection.id = None
+        self.scheduler.cancelAll()
         if self.delegate is not None: self.delegate.on_disconnect()
 
     def onConnectionStatusEvent(self, message):
         self.connection.id = message.connection
+        self.connection.interval = message.conn_interval * 0.00125
+
+    def expect(self, messageClass, connection=None, handle=None):
+        """Register interest in an incoming message before sending the
+        command that triggers it, so that a quick reply cannot be missed.
+        """
+        waiter = BleWaiter(messageClass, connection, handle)
+        with self.waitersLock:
+            self.waiters.setdefault(messageClass, []).append(waiter)
+        return waiter
+
+    def discard(self, *waiters):
+        """Unregister waiters that were not waited for. Returns True if any
+        was still pending.
+        """
+        discarded = False
+        with self.waitersLock:
+            for waiter in waiters:
+                pending = self.waiters.get(waiter.messageClass, [])
+                if waiter in pending:
+                    pending.remove(waiter)
+                    discarded = True
+        return discarded
 
-    def waitForMessage(self, message, timeout):
-        t = Timeout(timeout)
-        self.expectedMessage = message
-        self.actualMessage = None
-        while self.expectedMessage and not t.isExpired(): time.sleep(0.01)
-        return self.actualMessage
+    def expireWaiter(self, waiter):
+        if self.discard(waiter):
+            self.timeouts += 1
+        waiter.resolve()
 
-    def waitLocal(self, message):
-        msg = self.waitForMessage(message, self.localTimeout)
+    def waitForMessage(self, waiter, timeout):
+        if not waiter.wait(timeout):
+            self.expireWaiter(waiter)
+        return waiter.value
+
+    def waitLocal(self, waiter):
+        msg = self.waitForMessage(waiter, self.localTimeout)
         if not msg: raise BleLocalTimeout()
         return msg
 
-    def waitRemote(self, message, timeout=None):
-        msg = self.waitForMessage(message, timeout if timeout is not None else self.remoteTimeout)
+    def waitRemote(self, waiter, timeout=None):
+        msg = self.waitForMessage(waiter, timeout if timeout is not None else self.remoteTimeout)
         if not msg: raise BleRemoteTimeout()
         return msg
 
     def connect(self):
         logging.info('Connecting to %s...' % macString(self.connection.address))
-        self.com.send(ConnectDirectCommand(self.connection.address))
-        self.waitLocal(ConnectDirectResponse())
+        response = self.expect(ConnectDirectResponse)
+        status = self.expect(ConnectionStatusEvent)
         try:
-            msg = self.waitRemote(ConnectionStatusEvent())
-        except BleRemoteTimeout:
-            logging.error('Failed connecting to %s' % macString(self.connection.address))
-            raise
+            with self.com.connectLock:
+                self.com.send(ConnectDirectCommand(self.connection.address))
+                result = self.waitLocal(response).result
+                if result:
+                    # E.g. 0x0181 while an earlier attempt is still running
+                    self.endProcedure()
+                    raise BleProcedureFailure('Connect rejected with result 0x%04X' % result)
+                try:
+                    msg = self.waitRemote(status)
+                except BleRemoteTimeout:
+                    logging.error('Failed connecting to %s' % macString(self.connection.address))
+                    self.endProcedure()
+                    raise
+        finally:
+            self.discard(response, status)
         logging.info('Connected to %s' % macString(self.connection.address))
-        self.connection.id = msg.connection
+        self.onConnectionStatusEvent(msg)
+
+    def endProcedure(self):
+        """End the GAP procedure left running by a connect attempt that
+        did not complete. Until then the dongle rejects the next attempt.
+        """
+        response = self.expect(GapEndProcedureResponse)
+        try:
+            self.com.send(GapEndProcedureCommand())
+            self.waitLocal(response)
+        finally:
+            self.discard(response)
+
+    def disconnect(self):
+        """Drop the link. The disconnected event follows as usual."""
+        if self.isConnected():
+            self.com.send(ConnectionDisconnectCommand(self.connection.id))
 
     def writeAttribute(self, uuid, data):
         logging.debug('Write attribute %s = %s' % (uuid, str(data)))
@@ -108,15 +483,30 @@ class BleManager:
         self.writeAttributeByHandle(handle, data)
 
     def writeAttributeByHandle(self, handle, data, wait=True):
-        self.com.send(AttClientAttributeWriteCommand(self.connection.id, handle, data))
-        if wait:
-            self.waitLocal(AttClientAttributeWriteResponse())
-            self.completeProcedure()
+        """Queue an attribute write and return its GattRequest. With wait,
+        block until the write procedure completed and raise on failure.
+        """
+        request = self.request(AttClientAttributeWriteCommand(self.connection.id, handle, data),
+                               AttClientAttributeWriteResponse, handle=handle)
+        if wait: request.result()
+        return request
 
-    def completeProcedure(self):
-        msg = self.waitRemote(AttClientProcedureCompleted())
-        logging.debug('Procedure completed')
-        return msg.result == 0
+    def writeCommandByHandle(self, handle, data):
+        """Queue a write without response and return its GattRequest, done
+        once the dongle accepted the write.
+        """
+        return self.request(AttClientWriteCommand(self.connection.id, handle, data),
+                            AttClientWriteCommandResponse, None)
+
+    def request(self, command, responseClass, completionClass=AttClientProcedureCompleted, handle=None):
+        """Queue a GATT command on the scheduler and return its GattRequest.
+        Without a connection the request fails right away.
+        """
+        request = GattRequest(command, responseClass, completionClass, handle)
+        if not self.isConnected():
+            request.resolve(error=BleNotConnected())
+            return request
+        return self.scheduler.submit(request)
 
     def configClientCharacteristic(self, handle, notify=False, indicate=False):
         NOTIFY_ENABLE = 1
@@ -128,40 +518,53 @@ class BleManager:
 
     def isConnected(self): return self.connection.id is not None
 
-    def waitValue(self, uuid):
-        handle = self.connection.handleByUuid(uuid)
-        return self.waitRemote(AttClientAttributeValueEvent()).data
-
     def readAttribute(self, uuid):
         logging.info('Reading attribute %s' % uuid)
         handle = self.connection.handleByUuid(uuid)
-        self.com.send(AttClientReadByHandleCommand(self.connection.id,
-                                                           handle))
-        self.waitLocal(AttClientReadByHandleResponse())
-        return self.waitValue(uuid)
+        return self.request(AttClientReadByHandleCommand(self.connection.id, handle),
+                            AttClientReadByHandleResponse, AttClientAttributeValueEvent, handle).result().data
 
     def readAll(self):
         return self.readByGroupType(1, 0xFFFF, Uint16(int('2800',16)).serialize())
 
     def readByGroupType(self, start, end, uuid):
-        self.groups = {}
-        self.com.send(ReadByGroupTypeCommand(self.connection.id, start, end, uuid))
-        self.waitLocal(ReadByGroupTypeResponse())
-        self.completeProcedure()
-        return self.groups
+        request = self.request(ReadByGroupTypeCommand(self.connection.id, start, end, uuid),
+                               ReadByGroupTypeResponse)
+        request.result()
+        return request.found
 
     def onAttClientGroupFoundEvent(self, message):
-        self.groups[message.uuid] = AttributeGroup(message.uuid, message.start, message.end)
+        self.collect(message.uuid, AttributeGroup(message.uuid, message.start, message.end))
 
-    def findInformation(self, start, end):
-        self.handles = {}
-        self.com.send(AttClientFindInformationCommand(self.connection.id, start, end))
-        self.waitLocal(AttClientFindInformationResponse())
-        self.completeProcedure()
-        return self.handles
+    def findInformation(self, start, end, wanted=None):
+        """Return the attribute handles by UUID in the given range. With a
+        list of wanted UUIDs, return as soon as all of them were found; the
+        rest of the procedure then completes in the background.
+        """
+        request = GattRequest(AttClientFindInformationCommand(self.connection.id, start, end),
+                              AttClientFindInformationResponse)
+        if wanted:
+            request.wanted = set(wanted)
+            request.satisfied = Future()
+            request.add_callback(lambda r: r.satisfied.resolve(r.value, r.error))
+        self.scheduler.submit(request)
+        if request.satisfied:
+            request.satisfied.wait()
+            if request.satisfied.error: raise request.satisfied.error
+        else:
+            request.result()
+        return request.found
 
     def onAttClientFindInformationFoundEvent(self, message):
-        self.handles[message.uuid] = message.chrHandle
+        self.collect(message.uuid, message.chrHandle)
+
+    def collect(self, key, value):
+        """Store a discovery result with the procedure that produced it."""
+        request = self.scheduler.runningProcedure()
+        if request:
+            request.found[key] = value
+            if request.wanted and request.wanted.issubset(request.found):
+                request.satisfied.resolve()
 
     def onAttClientAttributeValueEvent(self, message):
-        if self.delegate is not None: self.delegate.on_message(message)
\ No newline at end of file
+        if self.delegate is not None: self.delegate.on_message(message)
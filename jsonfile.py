@@ -0,0 +1,23 @@
+"""Small JSON files kept across runs, such as the handle and topology
+caches.
+"""
+
+import json
+import logging
+import os
+
+
+def save(path, data, what):
+    """Write data as JSON to path through a temporary file renamed over it,
+    so that a crash never leaves a partial file. Failures are logged as
+    not saving what. Returns whether the file was written.
+    """
+    try:
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp, path)
+        return True
+    except (IOError, OSError) as e:
+        logging.warning('Could not save %s: %s' % (what, e))
+        return False
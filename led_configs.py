@@ -1,128 +1,183 @@
-default = "   ***   " \
-          "  *   *  " \
-          "  *      " \
-          "  *      " \
-          "   ***   " \
-          "      *  " \
-          "      *  " \
-          "  *   *  " \
-          "   ***   "
-
-play = "         " \
-       "   *     " \
-       "   **    " \
-       "   ***   " \
-       "   ****  " \
-       "   ***   " \
-       "   **    " \
-       "   *     " \
-       "         "
-
-pause = "         " \
-        "  ** **  " \
-        "  ** **  " \
-        "  ** **  " \
-        "  ** **  " \
-        "  ** **  " \
-        "  ** **  " \
-        "  ** **  " \
-        "         "
-
-next = "         " \
-       "  *   *  " \
-       "  **  *  " \
-       "  *** *  " \
-       "  *****  " \
-       "  *** *  " \
-       "  **  *  " \
-       "  *   *  " \
-       "         "
-
-previous = "         " \
-           "  *   *  " \
-           "  *  **  " \
-           "  * ***  " \
-           "  *****  " \
-           "  * ***  " \
-           "  *  **  " \
-           "  *   *  " \
-           "         "
-vol0 = "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         "
-
-vol1 = "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       " *       " \
-       "         "
-
-vol2 = "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "  *      " \
-       " **      " \
-       "         "
-
-vol3 = "         " \
-       "         " \
-       "         " \
-       "         " \
-       "         " \
-       "   *     " \
-       "  **     " \
-       " ***     " \
-       "         "
-
-vol4 = "         " \
-       "         " \
-       "         " \
-       "         " \
-       "    *    " \
-       "   **    " \
-       "  ***    " \
-       " ****    " \
-       "         "
-
-vol5 = "         " \
-       "         " \
-       "         " \
-       "     *   " \
-       "    **   " \
-       "   ***   " \
-       "  ****   " \
-       " *****   " \
-       "         "
-
-vol6 = "         " \
-       "         " \
-       "      *  " \
-       "     **  " \
-       "    ***  " \
-       "   ****  " \
-       "  *****  " \
-       " ******  " \
-       "         "
-
-vol7 = "         " \
-       "       * " \
-       "      ** " \
-       "     *** " \
-       "    **** " \
-       "   ***** " \
-       "  ****** " \
-       " ******* " \
-       "         "
\ No newline at end of file
+import collections
+
+
+class LedFrame(object):
+    """LED matrix image compiled to the 11 bitmap bytes of the Nuimo LED
+    characteristic. Any character other than ' ' or '0' lights a LED.
+    """
+
+    __slots__ = ('matrix', 'bitmap', 'payloads')
+
+    # Frames compiled from dynamic matrix strings, least recently used first
+    cache = collections.OrderedDict()
+    cache_size = 64
+
+    def __init__(self, matrix):
+        self.matrix = '{:<81}'.format(matrix[:81])
+        self.bitmap = tuple(sum(1 << bit for bit, led in enumerate(self.matrix[i:i + 8]) if led not in ' 0')
+                            for i in range(0, 81, 8))
+        self.payloads = {}
+
+    def payload(self, brightness, timeout):
+        """The 13 byte LED characteristic value showing this frame."""
+        key = (brightness, timeout)
+        payload = self.payloads.get(key)
+        if payload is None:
+            payload = list(self.bitmap) + [max(0, min(255, int(255.0 * brightness))),
+                                           max(0, min(255, int(timeout * 10.0)))]
+            self.payloads[key] = payload
+        return payload
+
+    @classmethod
+    def get(cls, matrix):
+        """Return matrix as a frame, compiling strings through an LRU cache."""
+        if isinstance(matrix, LedFrame):
+            return matrix
+        frame = cls.cache.pop(matrix, None)
+        if frame is None:
+            frame = LedFrame(matrix)
+            if len(cls.cache) >= cls.cache_size:
+                cls.cache.popitem(last=False)
+        cls.cache[matrix] = frame
+        return frame
+
+
+default = LedFrame("   ***   " \
+                   "  *   *  " \
+                   "  *      " \
+                   "  *      " \
+                   "   ***   " \
+                   "      *  " \
+                   "      *  " \
+                   "  *   *  " \
+                   "   ***   ")
+
+play = LedFrame("         " \
+                "   *     " \
+                "   **    " \
+                "   ***   " \
+                "   ****  " \
+                "   ***   " \
+                "   **    " \
+                "   *     " \
+                "         ")
+
+pause = LedFrame("         " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "  ** **  " \
+                 "         ")
+
+next = LedFrame("         " \
+                "  *   *  " \
+                "  **  *  " \
+                "  *** *  " \
+                "  *****  " \
+                "  *** *  " \
+                "  **  *  " \
+                "  *   *  " \
+                "         ")
+
+previous = LedFrame("         " \
+                    "  *   *  " \
+                    "  *  **  " \
+                    "  * ***  " \
+                    "  *****  " \
+                    "  * ***  " \
+                    "  *  **  " \
+                    "  *   *  " \
+                    "         ")
+
+vol0 = LedFrame("         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         ")
+
+vol1 = LedFrame("         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                " *       " \
+                "         ")
+
+vol2 = LedFrame("         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "  *      " \
+                " **      " \
+                "         ")
+
+vol3 = LedFrame("         " \
+                "         " \
+                "         " \
+                "         " \
+                "         " \
+                "   *     " \
+                "  **     " \
+                " ***     " \
+                "         ")
+
+vol4 = LedFrame("         " \
+                "         " \
+                "         " \
+                "         " \
+                "    *    " \
+                "   **    " \
+                "  ***    " \
+                " ****    " \
+                "         ")
+
+vol5 = LedFrame("         " \
+                "         " \
+                "         " \
+                "     *   " \
+                "    **   " \
+                "   ***   " \
+                "  ****   " \
+                " *****   " \
+                "         ")
+
+vol6 = LedFrame("         " \
+                "         " \
+                "      *  " \
+                "     **  " \
+                "    ***  " \
+                "   ****  " \
+                "  *****  " \
+                " ******  " \
+                "         ")
+
+vol7 = LedFrame("         " \
+                "       * " \
+                "      ** " \
+                "     *** " \
+                "    **** " \
+                "   ***** " \
+                "  ****** " \
+                " ******* " \
+                "         ")
+
+error = LedFrame("         " \
+                 " *     * " \
+                 "  *   *  " \
+                 "   * *   " \
+                 "    *    " \
+                 "   * *   " \
+                 "  *   *  " \
+                 " *     * " \
+                 "         ")
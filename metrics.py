@@ -0,0 +1,125 @@
+"""Optional instrumentation of the gesture pipeline: latency histograms per
+stage and gesture type, and counters, served in the Prometheus text format
+from a local HTTP endpoint.
+
+Notifications are stamped when the serial read returns. The stages are:
+
+    gatt     serial RX until the Nuimo queues the gesture
+    queue    waiting in the MessageHandler
+    handler  the delegate callback
+    sonos    each Sonos command, by command
+
+Nothing is recorded until enable() or serve() is called.
+"""
+
+import bisect
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HISTOGRAMS = {
+    'nuimo_stage_seconds': ('Time a gesture spent in a pipeline stage', ('stage', 'gesture')),
+    'sonos_command_seconds': ('Duration of a Sonos command', ('command',)),
+}
+
+enabled = False
+histograms = {}
+counters = []
+
+
+class Histogram(object):
+    """Bucket counts and sum of observed values. Updates take no lock; a
+    rare increment lost to a race only skews the distribution slightly.
+    """
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def observe(name, labels, value):
+    """Record value in histogram name for a tuple of label values, in the
+    order of its label names in HISTOGRAMS.
+    """
+    histogram = histograms.get((name, labels))
+    if histogram is None:
+        histogram = histograms.setdefault((name, labels), Histogram())
+    histogram.observe(value)
+
+
+def counter(name, help, read, **labels):
+    """Export read(), e.g. an attribute some object already counts, as a
+    counter. It is only called when the metrics are scraped.
+    """
+    counters.append((name, help, read, labels))
+
+
+def format_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (key, value) for key, value in labels) if labels else ''
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, (help, names) in sorted(HISTOGRAMS.items()):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for (family, values), histogram in sorted(histograms.items()):
+            if family != name:
+                continue
+            labels = zip(names, values)
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + [('le', bound)]), total))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), total))
+
+    described = set()
+    for name, help, read, labels in counters:
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %d' % (name, format_labels(sorted(labels.items())), read()))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=9464, address='127.0.0.1'):
+    """Enable the metrics and serve them at http://address:port/metrics
+    from a daemon thread. Returns the server; shutdown() stops it.
+    """
+    enable()
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,10 +1,16 @@
 from __future__ import division
 
+import collections
 import threading
 
 from bled112 import Bled112Com
-from gatt import BleManager, BleRemoteTimeout, BleLocalTimeout
+from led_configs import LedFrame
+from gatt import (BleManager, BleMultiplexer, BleRemoteTimeout, BleLocalTimeout, BleProcedureFailure,
+                  BleNotConnected, HandleCache)
+import hashlib
 import logging
+import metrics
+import random
 import time
 
 
@@ -23,6 +29,9 @@ CHARACTERISTIC_UUIDS = {
     'f29b1524-cb19-40f3-be5c-7241ecb82fd1': 'LED_MATRIX'
 }
 
+# Identifies the set of characteristics a cached handle table was built for
+HANDLE_SIGNATURE = hashlib.sha1(','.join(sorted(SERVICE_UUIDS + CHARACTERISTIC_UUIDS.keys()))).hexdigest()
+
 NOTIFICATION_CHARACTERISTIC_UUIDS = [
     'BATTERY',
     'BUTTON',
@@ -33,55 +42,105 @@ NOTIFICATION_CHARACTERISTIC_UUIDS = [
 
 
 class Nuimo:
-    def __init__(self, com, address, delegate):
+    """A Nuimo on its own BLED112, given by serial port, or sharing one
+    through a BleMultiplexer.
+    """
+    def __init__(self, com, address, delegate, handle_cache=None, led_without_response=False):
         self.com = com
         self.address = address
         self.delegate = delegate
         self.bled112 = None
         self.ble = None
         self.characteristics_handles = {}
+        self.handle_cache = handle_cache or HandleCache()
         self.message_handler = MessageHandler()
         self.message_handler.start()
-
-    def connect(self):
-        self.bled112 = Bled112Com(self.com)
-        self.bled112.start()
-        self.ble = BleManager(self.bled112, self.address, self)
-
-        while not self.ble.isConnected():
-            try:
-                self.ble.connect()
-
-                self._discover_characteristics()
-                self._setup_notifications()
-
-                self.delegate.on_connect()
-            except (BleRemoteTimeout, BleLocalTimeout):
-                time.sleep(5)
+        self.led = LedScheduler(self, led_without_response)
+        self.led.start()
+        self.supervisor = ConnectionSupervisor(self)
+        if metrics.enabled:
+            self._export_counters()
+
+    def connect(self, wait=True):
+        """Opens the adapter and starts the supervisor, which keeps the
+        Nuimo connected from then on. With wait, returns once it is first
+        ready.
+        """
+        if isinstance(self.com, BleMultiplexer):
+            channel = self.com.channel(self.address)
+        else:
+            self.bled112 = self._open_adapter()
+            self.bled112.start()
+            channel = self.bled112
+        self.ble = BleManager(channel, self.address, self)
+        self.supervisor.start()
+        if wait:
+            self.supervisor.wait_ready()
 
     def disconnect(self):
-        self.bled112.reset()
-        self.bled112.close()
+        self.supervisor.terminate()
+        if self.bled112:
+            self.bled112.reset()
+            self.bled112.close()
+        else:
+            # The shared adapter stays open for the other devices
+            self.ble.disconnect()
 
     def terminate(self):
+        self.supervisor.terminate()
         self.message_handler.terminate()
+        self.led.terminate()
+
+    def _export_counters(self):
+        metrics.counter('nuimo_reconnects_total', 'Link losses the supervisor reconnected after',
+                        lambda: self.supervisor.reconnects, nuimo=self.address)
+        metrics.counter('nuimo_events_total', 'Gestures queued for the delegate',
+                        lambda: self.message_handler.received, nuimo=self.address)
+        metrics.counter('nuimo_dropped_events_total', 'Gestures dropped from a full MessageHandler queue',
+                        lambda: self.message_handler.dropped, nuimo=self.address)
+        metrics.counter('nuimo_gatt_timeouts_total', 'GATT requests and expected messages that timed out',
+                        lambda: self.ble.timeouts if self.ble else 0, nuimo=self.address)
+
+    def _setup_connection(self):
+        if not self._restore_characteristics():
+            self._discover_characteristics()
+            self._setup_notifications()
+
+    def _open_adapter(self):
+        return Bled112Com(self.com)
+
+    def _restore_characteristics(self):
+        handles = self.handle_cache.get(self.address, HANDLE_SIGNATURE)
+        if handles is None:
+            return False
+
+        logging.debug("Using cached handles")
+        self.characteristics_handles = handles
+        try:
+            self._setup_notifications()
+            return True
+        except BleProcedureFailure:
+            logging.info("Cached handles rejected, rediscovering")
+            self.handle_cache.invalidate(self.address)
+            return False
 
     def _discover_characteristics(self):
-        logging.debug("Reading service groups")
-        groups = self.ble.readAll()
+        logging.debug("Discovering characteristics")
+        start = time.time()
+        issued = self.ble.scheduler.issued
 
+        # A single FindInformation over the whole table, ending once every
+        # wanted characteristic was seen
+        found = self.ble.findInformation(1, 0xFFFF, CHARACTERISTIC_UUIDS.keys())
         handles = {}
-        for group in groups.values():
-            if group.uuid not in SERVICE_UUIDS:
-                continue
-            group_handles = self.ble.findInformation(group.start, group.end)
-            for uuid, handle in group_handles.iteritems():
-                if uuid not in CHARACTERISTIC_UUIDS:
-                    continue
-                logging.debug("Found handle {} for {}".format(handle, uuid))
-                handles[uuid] = handle
+        for uuid, name in CHARACTERISTIC_UUIDS.items():
+            logging.debug("Found handle {} for {}".format(found[uuid], uuid))
+            handles[name] = found[uuid]
 
-        self.characteristics_handles = dict((name, handles[uuid]) for uuid, name in CHARACTERISTIC_UUIDS.items())
+        logging.info("Discovered {} characteristics in {} round trip(s), {:.0f} ms".format(
+            len(handles), self.ble.scheduler.issued - issued, (time.time() - start) * 1000))
+        self.characteristics_handles = handles
+        self.handle_cache.put(self.address, HANDLE_SIGNATURE, self.characteristics_handles)
 
     def _setup_notifications(self):
         for name in NOTIFICATION_CHARACTERISTIC_UUIDS:
@@ -90,31 +149,29 @@ class Nuimo:
 
 
     def display_led_matrix(self, matrix, timeout):
-        try:
-            matrix = '{:<81}'.format(matrix[:81])
-            bytes = list(map(lambda leds: reduce(lambda acc, led: acc + (1 << led if leds[led] not in [' ', '0'] else 0), range(0, len(leds)), 0), [matrix[i:i+8] for i in range(0, len(matrix), 8)]))
-            self.ble.writeAttributeByHandle(self.characteristics_handles['LED_MATRIX'], [bytes[0], bytes[1], bytes[2], bytes[3], bytes[4], bytes[5], bytes[6], bytes[7], bytes[8], bytes[9], bytes[10], max(0, min(255, int(255.0 * 1))), max(0, min(255, int(timeout * 10.0)))], False)
-        except Exception as e:
-            logging.exception(e)
+        """Show a precompiled LedFrame or an 81 character matrix string."""
+        self.led.show(LedFrame.get(matrix), timeout)
 
     def on_message(self, message):
+        received = getattr(message, 'received', None) if metrics.enabled else None
         if message.attHandle == self.characteristics_handles['BATTERY']:
             logging.debug('Battery state')
             level = int(message.data[0] / 255 * 100)
-            MessageHandler.queue((self.delegate.on_battery_state, level))
+            self.message_handler.queue((self.delegate.on_battery_state, level), latest_value,
+                                       gesture='battery', received=received)
         if message.attHandle == self.characteristics_handles['BUTTON']:
             if (message.data[0] == 1):
                 logging.debug('Button pressed')
-                MessageHandler.queue(self.delegate.on_button)
+                self.message_handler.queue(self.delegate.on_button, gesture='button', received=received)
             else:
                 logging.debug('Button released')
         elif message.attHandle == self.characteristics_handles['SWIPE']:
             if (message.data[0] == 0):
                 logging.debug('Swipe left')
-                MessageHandler.queue(self.delegate.on_swipe_left)
+                self.message_handler.queue(self.delegate.on_swipe_left, gesture='swipe_left', received=received)
             elif (message.data[0] == 1):
                 logging.debug('Swipe right')
-                MessageHandler.queue(self.delegate.on_swipe_right)
+                self.message_handler.queue(self.delegate.on_swipe_right, gesture='swipe_right', received=received)
             elif (message.data[0] == 2):
                 logging.debug('Swipe up')
             else:
@@ -123,32 +180,156 @@ class Nuimo:
             if (message.data[1] == 0):
                 value = message.data[0]
                 logging.debug('Wheel right, value: {}'.format(value))
-                MessageHandler.queue((self.delegate.on_wheel_right, value))
+                self.message_handler.queue((self.delegate.on_wheel_right, value), sum_values,
+                                           gesture='rotate_right', received=received)
             else:
                 value = 255 - message.data[0]
                 logging.debug('Wheel left, value: {}'.format(value))
-                MessageHandler.queue((self.delegate.on_wheel_left, value))
+                self.message_handler.queue((self.delegate.on_wheel_left, value), sum_values,
+                                           gesture='rotate_left', received=received)
         elif message.attHandle == self.characteristics_handles['FLY']:
             if (message.data[0] == 0):
                 logging.debug('Fly left')
-                MessageHandler.queue(self.delegate.on_fly_left)
+                self.message_handler.queue(self.delegate.on_fly_left, gesture='fly_left', received=received)
             elif (message.data[0] == 1):
                 logging.debug('Fly right')
-                MessageHandler.queue(self.delegate.on_fly_right)
+                self.message_handler.queue(self.delegate.on_fly_right, gesture='fly_right', received=received)
             elif (message.data[0] == 2):
                 logging.debug('Fly towards')
-                MessageHandler.queue(self.delegate.on_fly_towards)
+                self.message_handler.queue(self.delegate.on_fly_towards, gesture='fly_towards', received=received)
             elif (message.data[0] == 3):
                 logging.debug('Fly backwards')
-                MessageHandler.queue(self.delegate.on_fly_backwards)
+                self.message_handler.queue(self.delegate.on_fly_backwards, gesture='fly_backwards', received=received)
             else:
                 logging.debug('Fly up/down, value {}'.format(message.data[1]))
 
     def on_disconnect(self):
-        self.bled112.close()
-        time.sleep(5)
-        logging.debug('Reconnecting...')
-        self.connect()
+        self.supervisor.on_drop()
+
+class ConnectionSupervisor(threading.Thread):
+    """Keeps the Nuimo connected over the adapter opened once by connect().
+    The connection goes through DISCONNECTED, CONNECTING, DISCOVERING and
+    READY. Drops reported by the BLED112 thread are handled here. The first
+    retries after a failure are immediate, later ones back off exponentially
+    with jitter.
+    """
+
+    DISCONNECTED = 'disconnected'
+    CONNECTING = 'connecting'
+    DISCOVERING = 'discovering'
+    READY = 'ready'
+
+    def __init__(self, nuimo, fast_retries=2, base_delay=0.5, max_delay=30.0):
+        super(ConnectionSupervisor, self).__init__()
+        self.daemon = True
+        self.nuimo = nuimo
+        self.fast_retries = fast_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.state = self.DISCONNECTED
+        self.stop = False
+        self.failures = 0
+        # Every disconnected event, including those of failed setups
+        self.drops = 0
+        # Links back to READY after one was lost out of READY
+        self.reconnects = 0
+        self.attempts = 0
+        self.down_since = None
+        self.time_to_ready = collections.deque(maxlen=32)
+
+    def on_drop(self):
+        """Called by the BLED112 thread when the link is lost."""
+        with self.condition:
+            self.drops += 1
+            if self.state == self.READY:
+                self.down_since = time.time()
+            self.state = self.DISCONNECTED
+            self.condition.notify_all()
+
+    def wait_ready(self):
+        with self.condition:
+            while self.state != self.READY and not self.stop:
+                self.condition.wait()
+
+    def run(self):
+        self.down_since = time.time()
+        while True:
+            with self.condition:
+                while self.state == self.READY and not self.stop:
+                    self.condition.wait()
+                if self.stop:
+                    break
+
+            if not self._attempt():
+                self._pause()
+
+    def _set_state(self, state):
+        with self.condition:
+            logging.debug("Connection {}".format(state))
+            self.state = state
+            self.condition.notify_all()
+
+    def _failed(self):
+        self.failures += 1
+        self._set_state(self.DISCONNECTED)
+        try:
+            self.nuimo.ble.disconnect()
+        except Exception as e:
+            logging.exception(e)
+        return False
+
+    def _attempt(self):
+        drops = self.drops
+        self.attempts += 1
+        try:
+            self._set_state(self.CONNECTING)
+            self.nuimo.ble.connect()
+            self._set_state(self.DISCOVERING)
+            self.nuimo._setup_connection()
+        except (BleRemoteTimeout, BleLocalTimeout, BleProcedureFailure, BleNotConnected) as e:
+            logging.info("Connecting failed: {}".format(e.__class__.__name__))
+            return self._failed()
+        except Exception as e:
+            # Anything else must not end the thread and leave the Nuimo down
+            logging.exception(e)
+            return self._failed()
+
+        with self.condition:
+            # The link may have dropped right after the last procedure
+            if self.drops != drops or self.stop:
+                return False
+            elapsed = time.time() - self.down_since
+            if self.time_to_ready:
+                self.reconnects += 1
+            self.time_to_ready.append(elapsed)
+            self.failures = 0
+            self.state = self.READY
+            self.condition.notify_all()
+        logging.info("Nuimo ready after {:.0f} ms".format(elapsed * 1000))
+        self.nuimo.delegate.on_connect()
+        return True
+
+    def _pause(self):
+        """Waits for a half-open link to go down and for the backoff delay."""
+        delay = self.backoff(self.failures)
+        with self.condition:
+            if self.nuimo.ble.isConnected() and not self.stop:
+                self.condition.wait(self.nuimo.ble.remoteTimeout)
+            if delay and not self.stop:
+                self.condition.wait(delay)
+
+    def backoff(self, failures):
+        if failures <= self.fast_retries:
+            return 0
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - self.fast_retries - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def terminate(self):
+        with self.condition:
+            self.stop = True
+            self.condition.notify_all()
+
 
 class NuimoDelegate:
     def __init__(self):
@@ -193,42 +374,183 @@ class NuimoDelegate:
     def on_fly_backwards(self):
         pass
 
+def sum_values(queued, new):
+    return queued + new
+
+
+def latest_value(queued, new):
+    return new
+
+
 class MessageHandler(threading.Thread):
+    """Runs delegate callbacks off the BLED112 thread, in arrival order.
 
-    next_msg = None
+    A message queued with a merge function is combined with the message at
+    the tail of the queue if that calls the same function, e.g. consecutive
+    wheel events add up to one delta. Other messages are never dropped; when
+    the queue is full the oldest mergeable message makes room.
 
-    def __init__(self):
+    A message queued with the serial RX time of its notification records
+    the gatt, queue and handler stages for its gesture. A merged message
+    keeps the times of the first one.
+    """
+
+    def __init__(self, max_size=32):
         super(MessageHandler, self).__init__()
+        self.daemon = True
+        self.max_size = max_size
+        self.messages = collections.deque()
+        self.condition = threading.Condition()
         self.stop = False
+        self.received = 0
+        self.merged = 0
+        self.dropped = 0
 
     def run(self):
         while True:
-            if self.stop:
-                break
-
-            if not MessageHandler.next_msg:
-                time.sleep(0.01)
-                continue
-
+            with self.condition:
+                while not self.messages and not self.stop:
+                    self.condition.wait()
+                if self.stop:
+                    break
+                func, args, merge, gesture, enqueued = self.messages.popleft()
+
+            started = time.time() if enqueued else None
             try:
-                msg = MessageHandler.next_msg
-                if isinstance(msg, tuple):
-                    func = msg[0]
-                    args = msg[1:]
-                    func(*args)
-                else:
-                    msg()
+                func(*args)
             except Exception as e:
                 logging.exception(e)
-
-            MessageHandler.next_msg = None
+            if enqueued:
+                metrics.observe('nuimo_stage_seconds', ('queue', gesture), started - enqueued)
+                metrics.observe('nuimo_stage_seconds', ('handler', gesture), time.time() - started)
 
     def terminate(self):
-        self.stop = True
+        with self.condition:
+            self.stop = True
+            self.condition.notify()
+
+    def queue(self, msg, merge=None, gesture=None, received=None):
+        """Queue a callable, or a (callable, arg) tuple whose arg merge(queued,
+        new) can combine with that of an identical callable at the tail.
+        """
+        if isinstance(msg, tuple):
+            func, args = msg[0], msg[1:]
+        else:
+            func, args = msg, ()
+
+        enqueued = None
+        if received is not None:
+            enqueued = time.time()
+            metrics.observe('nuimo_stage_seconds', ('gatt', gesture), enqueued - received)
+
+        with self.condition:
+            self.received += 1
+            if merge and self.messages:
+                tail_func, tail_args, tail_merge, tail_gesture, tail_enqueued = self.messages[-1]
+                if tail_merge is merge and tail_func == func:
+                    self.messages[-1] = (func, (merge(tail_args[0], args[0]),), merge, tail_gesture, tail_enqueued)
+                    self.merged += 1
+                    return
+
+            if len(self.messages) >= self.max_size:
+                for queued in self.messages:
+                    if queued[2]:
+                        self.messages.remove(queued)
+                        self.dropped += 1
+                        break
+
+            self.messages.append((func, args, merge, gesture, enqueued))
+            self.condition.notify()
+
+
+class LedScheduler(threading.Thread):
+    """Output stage of the LED matrix. While the link is busy only the newest
+    frame is kept, a frame identical to the one being written or, if none
+    is, to the one on screen is dropped and at most one frame goes out per
+    connection interval. Frames are written with
+    or without response.
+    """
+
+    def __init__(self, nuimo, without_response=False):
+        super(LedScheduler, self).__init__()
+        self.daemon = True
+        self.nuimo = nuimo
+        self.without_response = without_response
+        self.condition = threading.Condition()
+        self.pending = None
+        self.shown = None
+        self.shown_until = 0
+        self.writing = None
+        self.stop = False
+        self.submitted = 0
+        self.sent = 0
+        self.duplicates = 0
+        self.superseded = 0
+        self.latest_delay = 0
+
+    def show(self, frame, timeout):
+        with self.condition:
+            self.submitted += 1
+            if self.pending is not None:
+                self.superseded += 1
+                self.pending = None
+            current = self.writing
+            if current is None and time.time() < self.shown_until:
+                current = self.shown
+            if (frame, timeout) == current:
+                self.duplicates += 1
+                return
+            self.pending = (frame, timeout, time.time())
+            self.condition.notify()
+
+    def run(self):
+        last_sent = 0
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stop:
+                    self.condition.wait()
+                if self.stop:
+                    break
+
+            delay = last_sent + self.nuimo.ble.connection.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.condition:
+                if self.pending is None:
+                    continue
+                frame, timeout, submitted = self.pending
+                self.pending = None
+                self.writing = (frame, timeout)
+
+            last_sent = time.time()
+            try:
+                # Newer frames replace the pending one until the write is done
+                self._write(frame.payload(1, timeout)).result()
+            except Exception as e:
+                if isinstance(e, BleNotConnected):
+                    logging.debug("LED frame dropped while disconnected")
+                else:
+                    logging.exception(e)
+                with self.condition:
+                    self.writing = None
+                continue
+
+            with self.condition:
+                self.writing = None
+                self.sent += 1
+                self.shown = (frame, timeout)
+                self.shown_until = last_sent + timeout
+                self.latest_delay = time.time() - submitted
 
-    @staticmethod
-    def queue(msg):
-        if (MessageHandler.next_msg):
-            return
+    def _write(self, payload):
+        ble = self.nuimo.ble
+        handle = self.nuimo.characteristics_handles['LED_MATRIX']
+        if self.without_response:
+            return ble.writeCommandByHandle(handle, payload)
+        return ble.writeAttributeByHandle(handle, payload, False)
 
-        MessageHandler.next_msg = msg
+    def terminate(self):
+        with self.condition:
+            self.stop = True
+            self.condition.notify()
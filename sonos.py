@@ -1,10 +1,21 @@
+import json
 import logging
+import os
 import threading
-from Queue import Empty
+import time
+import xml.etree.ElementTree as XML
+from Queue import Queue
+from urlparse import urlparse
 
+import requests
 import soco
+import soco.services
 from soco.events import event_listener
 
+import jsonfile
+import metrics
+from futures import CountDown, Future
+
 
 class SonosAPI:
 
@@ -12,17 +23,149 @@ class SonosAPI:
     STATE_PAUSED = 'PAUSED_PLAYBACK'
     STATE_TRANSITIONING = 'TRANSITIONING'
 
-    def __init__(self):
-        self.players = soco.discover()
+    def __init__(self, players=None, workers=6, volume_timeout=1.0, pool_size=2, pool_idle=20.0,
+                 topology_cache=None):
+        started = time.time()
 
-        for player in self.players:
-            if player.is_coordinator:
-                self.coordinator = player
+        # SOAP calls of all speakers reuse keep-alive connections
+        self.http = HttpPool(pool_size, pool_idle)
+        self.http.install()
 
         self.state = 'UNKNOWN'
+        self.on_state = None
+        # Transport state per group coordinator, and the rooms served
+        self.states = {}
+        self.zones = []
+
+        # Transport commands run one after another off the caller's thread,
+        # on a thread per group coordinator so that a slow room does not
+        # hold up the others
+        self.commands = WorkerPool(1)
+        self.coordinator_commands = {}
+        self.coordinator_commands_lock = threading.Lock()
+
+        # Last known volume and its update time per player, fed by
+        # RenderingControl events and our own writes
+        self.volumes = {}
+        self.volume_lock = threading.Lock()
+        self.volume_reads = 0
+        self.volume_reads_avoided = 0
+
+        # Volume writes run on a bounded pool; a player with a write in
+        # progress only has its newest value pending here
+        self.workers = WorkerPool(workers)
+        self.volume_timeout = volume_timeout
+        self.volume_pending = {}
+        self.volume_timeouts = 0
+        # Events arriving while our write is in flight, or reporting another
+        # value within volume_grace of our last successful write, may predate
+        # it. They are not applied; instead the player is read again once the
+        # grace period is over.
+        self.volume_written = {}
+        self.volume_grace = 1.0
+        self.volume_recheck = {}
+
+        self.players = []
+        self.coordinator = None
+        self.groups = {}
+        self.topology = None
+        self.coordinator_uid = None
+        self.topology_lock = threading.RLock()
+        self.topology_cache = None
+
+        # All subscriptions feed one queue, drained by a single thread
+        self.dispatcher = EventDispatcher()
+        self.dispatcher.start()
+
+        source = 'given'
+        if players is not None:
+            coordinator = find_coordinator(players)
+            groups = dict((player.player_name, (coordinator, list(players))) for player in players)
+            self._set_players(list(players), coordinator, groups)
+        else:
+            self.topology_cache = topology_cache or TopologyCache()
+            entries = self.topology_cache.get()
+            if entries:
+                source = 'cache'
+                self._apply_topology(entries)
+                # Reconcile the cached topology with the live one in the background
+                rediscovery = threading.Thread(target=self._rediscover)
+                rediscovery.daemon = True
+                rediscovery.start()
+            else:
+                source = 'discovery'
+                self._rediscover()
+
+        self.startup_time = time.time() - started
+        logging.info("Sonos ready in {:.0f} ms ({} players from {})".format(
+            self.startup_time * 1000, len(self.players), source))
+
+    def _rediscover(self):
+        try:
+            entries = describe_players(soco.discover() or [])
+        except Exception as e:
+            logging.warning("Sonos discovery failed: {}".format(e))
+            return
+        if not entries:
+            logging.warning("No Sonos players found")
+            return
+        self._apply_topology(entries)
+
+    def _apply_topology(self, entries):
+        """Switches to the players described by entries, keeping the current
+        coordinator if it still leads a group, and stores them in the cache.
+        """
+        with self.topology_lock:
+            if entries == self.topology:
+                return
 
-        self.eventReceiver = EventReceiver(self.coordinator, self._on_state_change)
-        self.eventReceiver.start()
+            leaders = [entry for entry in entries if entry['uid'] == entry['group']]
+            chosen = next((entry for entry in leaders if entry['uid'] == self.coordinator_uid), None)
+            chosen = chosen or (leaders or entries)[0]
+
+            logging.info("Sonos topology: {} players, coordinator {}".format(len(entries), chosen['name']))
+            self.topology = entries
+            self.coordinator_uid = chosen['uid']
+            self._set_players([soco.SoCo(entry['ip']) for entry in entries], soco.SoCo(chosen['ip']),
+                              describe_groups(entries))
+            if self.topology_cache:
+                self.topology_cache.put(entries)
+
+    def _set_players(self, players, coordinator, groups):
+        with self.topology_lock:
+            self.players = players
+            self.coordinator = coordinator
+            self.groups = groups
+            if coordinator is None:
+                logging.warning("No Sonos coordinator found")
+                self.dispatcher.route({})
+                return
+
+            routes = {coordinator.zoneGroupTopology: self._on_topology_event}
+            for leader in set([coordinator] + [group[0] for group in groups.values()]):
+                routes[leader.avTransport] = self._make_transport_callback(leader)
+            for player in players:
+                routes[player.renderingControl] = self._make_rendering_callback(player)
+            self.dispatcher.route(routes)
+
+    def _on_topology_event(self, event):
+        state = event.variables.get('zone_group_state')
+        if state:
+            entries = parse_zone_group_state(state)
+            if entries:
+                self._apply_topology(entries)
+
+    def _make_transport_callback(self, player):
+        def on_transport_event(event):
+            state = event.transport_state
+            if state != self.STATE_TRANSITIONING:
+                self.states[player] = state
+                for zone in self.zones:
+                    if zone.on_state and zone.coordinator is player:
+                        zone.on_state(state)
+            if player is self.coordinator:
+                self._on_state_change(state)
+        return on_transport_event
 
     def _on_state_change(self, new_state):
         logging.debug("New transport state: {}".format(new_state))
@@ -31,59 +174,495 @@ class SonosAPI:
             return
 
         self.state = new_state
+        if self.on_state:
+            self.on_state(new_state)
+
+    def _make_rendering_callback(self, player):
+        def on_rendering_event(event):
+            volume = event.variables.get('volume')
+            if volume and 'Master' in volume:
+                logging.debug("New volume of {}: {}".format(player.player_name, volume['Master']))
+                value = int(volume['Master'])
+                with self.volume_lock:
+                    now = time.time()
+                    written = self.volume_written.get(player)
+                    if player in self.volume_pending:
+                        self.volume_recheck[player] = now + self.volume_grace
+                        return
+                    if written and written[0] != value and now - written[1] < self.volume_grace:
+                        self.volume_recheck[player] = written[1] + self.volume_grace
+                        return
+                    self.volume_recheck.pop(player, None)
+                self._update_volume(player, value)
+        return on_rendering_event
+
+    def _update_volume(self, player, value):
+        with self.volume_lock:
+            self.volumes[player] = (value, time.time())
 
     def disconnect(self):
-        self.eventReceiver.stop()
+        self.commands.shutdown()
+        with self.coordinator_commands_lock:
+            pools = self.coordinator_commands.values()
+            self.coordinator_commands = {}
+        for pool in pools:
+            pool.shutdown()
+        self.dispatcher.stop()
+        self.dispatcher.join()
+        if event_listener.is_running:
+            event_listener.stop()
+        self.workers.shutdown()
+        self.http.uninstall()
 
     def is_playing(self):
         return self.state == self.STATE_PLAYING
 
+    def zone(self, name):
+        """A SonosZone for the group the player called name belongs to."""
+        zone = SonosZone(self, name)
+        self.zones.append(zone)
+        return zone
+
+    def submit(self, command, *args):
+        """Runs command(*args) on the command thread and returns a Future."""
+        return self.submit_to(self.commands, command, *args)
+
+    def commands_for(self, coordinator):
+        """The command thread of a group coordinator, started on first use."""
+        if coordinator is None:
+            return self.commands
+        with self.coordinator_commands_lock:
+            pool = self.coordinator_commands.get(coordinator)
+            if pool is None:
+                pool = self.coordinator_commands[coordinator] = WorkerPool(1)
+            return pool
+
+    def submit_to(self, pool, command, *args):
+        if not metrics.enabled:
+            return pool.submit(command, *args)
+
+        started = time.time()
+        future = pool.submit(command, *args)
+        future.add_callback(lambda future: metrics.observe(
+            'sonos_command_seconds', (command.__name__,), time.time() - started))
+        return future
+
+    def predict_state(self, state):
+        """Assumes state until events report otherwise. Returns the previous
+        state so that a failed command can restore it.
+        """
+        previous, self.state = self.state, state
+        return previous
+
     def get_volume(self):
-        return self.coordinator.volume
+        coordinator = self.coordinator
+        return self.get_player_volume(coordinator) if coordinator else None
+
+    def get_player_volume(self, player):
+        """Volume of a player from the local model, read from the player
+        only if no event or write has reported it yet, or if an event that
+        was not applied may have reported a change.
+        """
+        with self.volume_lock:
+            known = self.volumes.get(player)
+            recheck = self.volume_recheck.get(player)
+            if recheck is not None and time.time() >= recheck and player not in self.volume_pending:
+                del self.volume_recheck[player]
+                known = None
+            if known is not None:
+                self.volume_reads_avoided += 1
+                return known[0]
+            self.volume_reads += 1
+
+        volume = player.volume
+        self._update_volume(player, volume)
+        return volume
+
+    def volume_staleness(self):
+        """Seconds since the coordinator's volume was last reported, or None
+        if it never was.
+        """
+        with self.volume_lock:
+            known = self.volumes.get(self.coordinator)
+        return time.time() - known[1] if known else None
 
     def play(self):
-        self.coordinator.play()
+        if self.coordinator:
+            self.coordinator.play()
 
     def pause(self):
-        self.coordinator.pause()
+        if self.coordinator:
+            self.coordinator.pause()
 
     def next(self):
-        self.coordinator.next()
+        if self.coordinator:
+            self.coordinator.next()
 
     def prev(self):
-        self.coordinator.previous()
+        if self.coordinator:
+            self.coordinator.previous()
+
+    def set_volume(self, value):
+        self._set_volume(max(0, min(100, value)))
 
     def vol_up(self, value):
-        self._set_volume(self.coordinator.volume + value)
+        self.set_volume((self.get_volume() or 0) + value)
 
     def vol_down(self, value):
-        self._set_volume(self.coordinator.volume - value)
+        self.set_volume((self.get_volume() or 0) - value)
 
-    def _set_volume(self, value):
-        for player in self.players:
-            player.volume = value
+    def _set_volume(self, value, players=None):
+        """Writes the volume to all players, or the given ones, at once and waits up to
+        volume_timeout for them. A player still busy with an earlier write
+        picks up the new value when that one returns, so a slow speaker
+        holds at most one worker and never delays the others.
+        """
+        writes = []
+        players = self.players if players is None else players
+        with self.volume_lock:
+            for player in players:
+                if player not in self.volume_pending:
+                    writes.append(player)
+                self.volume_pending[player] = value
+                self.volumes[player] = (value, time.time())
 
+        started = time.time()
+        fanout = CountDown(len(writes))
+        for player in writes:
+            self.workers.submit(self._write_volume, player, fanout)
+        if not fanout.wait(self.volume_timeout):
+            self.volume_timeouts += 1
+            logging.warning("Volume write timed out after {}s".format(self.volume_timeout))
+        if metrics.enabled:
+            metrics.observe('sonos_command_seconds', ('set_volume',), time.time() - started)
 
-class EventReceiver(threading.Thread):
+    def _write_volume(self, player, fanout):
+        with self.volume_lock:
+            value = self.volume_pending[player]
+        while True:
+            try:
+                player.volume = value
+                applied = True
+            except Exception as e:
+                logging.warning("Setting volume of {} failed: {}".format(player.player_name, e))
+                applied = False
+            if fanout:
+                fanout.finish()
+                fanout = None
+            with self.volume_lock:
+                latest = self.volume_pending[player]
+                if latest == value:
+                    del self.volume_pending[player]
+                    if applied:
+                        self.volume_written[player] = (value, time.time())
+                    else:
+                        # The model holds a value the player never took
+                        self.volume_written.pop(player, None)
+                        self.volumes.pop(player, None)
+                    return
+            value = latest
 
-    def __init__(self, coordinator, state_callback):
-        super(EventReceiver, self).__init__()
-        self.subscription = coordinator.avTransport.subscribe()
-        self.state_callback = state_callback
-        self.terminate = False
+
+class EventDispatcher(threading.Thread):
+    """Receives the events of all subscriptions through one queue and hands
+    each to the handler routed for its service. The thread sleeps until an
+    event or stop() arrives; soco renews the subscriptions.
+    """
+
+    def __init__(self):
+        super(EventDispatcher, self).__init__()
+        self.events = Queue()
+        self.handlers = {}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.dispatched = 0
+
+    def route(self, routes):
+        """Subscribes to the services in routes, a dict of service to handler,
+        and cancels subscriptions to services no longer in it.
+        """
+        with self.lock:
+            stale = [service for service in self.subscriptions if service not in routes]
+            new = [service for service in routes if service not in self.subscriptions]
+            self.handlers = dict(routes)
+        for service in stale:
+            self._unsubscribe(self.subscriptions.pop(service))
+        for service in new:
+            try:
+                self.subscriptions[service] = service.subscribe(auto_renew=True, event_queue=self.events)
+            except Exception as e:
+                logging.warning("Subscribing to {} failed: {}".format(service, e))
 
     def run(self):
         while True:
-            if self.terminate:
-                self.subscription.unsubscribe()
-                event_listener.stop()
+            event = self.events.get()
+            if event is None:
                 break
+            with self.lock:
+                handler = self.handlers.get(event.service)
+            if handler:
+                try:
+                    handler(event)
+                except Exception as e:
+                    logging.exception(e)
+            self.dispatched += 1
 
-            try:
-                event = self.subscription.events.get(timeout=0.5)
-                self.state_callback(event.transport_state)
-            except Empty:
-                pass
+        for subscription in self.subscriptions.values():
+            self._unsubscribe(subscription)
+        self.subscriptions = {}
+
+    def _unsubscribe(self, subscription):
+        try:
+            subscription.unsubscribe()
+        except Exception as e:
+            logging.warning("Unsubscribing failed: {}".format(e))
 
     def stop(self):
-        self.terminate = True
+        self.events.put(None)
+
+class SonosZone:
+    """One room on a shared SonosAPI: the group of the player called name.
+    It offers the calls the controller makes on SonosAPI, aimed at that
+    group's coordinator and members only.
+    """
+
+    def __init__(self, sonos, name):
+        self.sonos = sonos
+        self.name = name
+        self.on_state = None
+
+    @property
+    def coordinator(self):
+        return self.sonos.groups.get(self.name, (None, []))[0]
+
+    @property
+    def players(self):
+        return self.sonos.groups.get(self.name, (None, []))[1]
+
+    @property
+    def state(self):
+        return self.sonos.states.get(self.coordinator, 'UNKNOWN')
+
+    def is_playing(self):
+        return self.state == SonosAPI.STATE_PLAYING
+
+    def predict_state(self, state):
+        coordinator = self.coordinator
+        previous = self.state
+        if coordinator:
+            self.sonos.states[coordinator] = state
+        return previous
+
+    def submit(self, command, *args):
+        return self.sonos.submit_to(self.sonos.commands_for(self.coordinator), command, *args)
+
+    def play(self):
+        if self.coordinator:
+            self.coordinator.play()
+
+    def pause(self):
+        if self.coordinator:
+            self.coordinator.pause()
+
+    def next(self):
+        if self.coordinator:
+            self.coordinator.next()
+
+    def prev(self):
+        if self.coordinator:
+            self.coordinator.previous()
+
+    def get_volume(self):
+        coordinator = self.coordinator
+        return self.sonos.get_player_volume(coordinator) if coordinator else None
+
+    def set_volume(self, value):
+        self.sonos._set_volume(max(0, min(100, value)), self.players)
+
+    def vol_up(self, value):
+        self.set_volume((self.get_volume() or 0) + value)
+
+    def vol_down(self, value):
+        self.set_volume((self.get_volume() or 0) - value)
+
+    def disconnect(self):
+        # The shared SonosAPI is disconnected by its owner
+        pass
+
+
+def find_coordinator(players):
+    for player in players:
+        if player.is_coordinator:
+            return player
+    return None
+
+
+def describe_players(players):
+    """Topology entries of discovered players, sorted by uid."""
+    entries = []
+    for player in players:
+        group = player.group
+        entries.append({
+            'ip': player.ip_address,
+            'uid': player.uid,
+            'name': player.player_name,
+            'group': group.coordinator.uid if group and group.coordinator else player.uid,
+        })
+    return sorted(entries, key=lambda entry: entry['uid'])
+
+
+def describe_groups(entries):
+    """Coordinator and members of the group of each player, by player name."""
+    players = dict((entry['uid'], soco.SoCo(entry['ip'])) for entry in entries)
+    groups = {}
+    for entry in entries:
+        members = [players[other['uid']] for other in entries if other['group'] == entry['group']]
+        groups[entry['name']] = (players.get(entry['group'], players[entry['uid']]), members)
+    return groups
+
+
+def parse_zone_group_state(state):
+    """Topology entries from a ZoneGroupState document as sent with
+    ZoneGroupTopology events. Invisible members like bonded surrounds are
+    left out, as discovery does.
+    """
+    if isinstance(state, unicode):
+        state = state.encode('utf-8')
+    entries = []
+    for group in XML.fromstring(state).iter('ZoneGroup'):
+        for member in group.findall('ZoneGroupMember'):
+            if member.get('Invisible') == '1':
+                continue
+            entries.append({
+                'ip': urlparse(member.get('Location')).hostname,
+                'uid': member.get('UUID'),
+                'name': member.get('ZoneName'),
+                'group': group.get('Coordinator'),
+            })
+    return sorted(entries, key=lambda entry: entry['uid'])
+
+
+class TopologyCache:
+    """Players, their groups and the coordinator from the last discovery,
+    persisted as JSON so that startup does not wait for SSDP.
+    """
+
+    def __init__(self, path='~/.nuimo_sonos.json'):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f).get('players')
+        except (IOError, ValueError, AttributeError):
+            self.entries = None
+
+    def get(self):
+        return self.entries
+
+    def put(self, entries):
+        self.entries = entries
+        self.save()
+
+    def save(self):
+        with self.lock:
+            jsonfile.save(self.path, {'players': self.entries}, 'Sonos topology cache')
+
+
+class HttpPool:
+    """Stands in for the requests module used by soco.services and sends
+    GET and POST through one keep-alive session per speaker. Sessions
+    unused for idle_timeout seconds are closed, as the speaker will have
+    dropped their connections by then.
+    """
+
+    def __init__(self, size=2, idle_timeout=20.0):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.original = None
+        self.created = 0
+        self.evicted = 0
+
+    def install(self):
+        if soco.services.requests is not self:
+            self.original = soco.services.requests
+            soco.services.requests = self
+
+    def uninstall(self):
+        if soco.services.requests is self:
+            soco.services.requests = self.original
+        self.close()
+
+    def __getattr__(self, name):
+        # Exceptions, structures and other verbs come from requests itself
+        return getattr(requests, name)
+
+    def get(self, url, **kwargs):
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session(url).post(url, **kwargs)
+
+    def session(self, url):
+        host = urlparse(url).netloc
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            entry = self.sessions.get(host)
+            if entry is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.size)
+                session.mount('http://', adapter)
+                self.created += 1
+            else:
+                session = entry[0]
+            self.sessions[host] = (session, now)
+        return session
+
+    def _evict(self, now):
+        for host, (session, used) in self.sessions.items():
+            if now - used > self.idle_timeout:
+                del self.sessions[host]
+                session.close()
+                self.evicted += 1
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for session, _ in sessions.values():
+            session.close()
+
+
+class WorkerPool:
+    """Fixed number of daemon threads running submitted calls in order."""
+
+    def __init__(self, size):
+        self.tasks = Queue()
+        self.threads = [threading.Thread(target=self._work) for _ in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, *args):
+        """Queues function(*args) and returns a Future for its outcome."""
+        future = Future()
+        self.tasks.put((function, args, future))
+        return future
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            function, args, future = task
+            try:
+                future.resolve(function(*args))
+            except Exception as e:
+                future.resolve(error=e)
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()